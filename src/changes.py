@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+import tempfile
+from string import Template
+
+ADDED = "added"
+MODIFIED = "modified"
+REMOVED = "removed"
+
+# Status letters of the changes file handed to scripts, as in `git status --short`
+_STATUS_LETTERS = {ADDED: "A", MODIFIED: "M", REMOVED: "D"}
+
+
+class FileChanges:
+    """
+    The files added, modified and removed by a batch of changes, each mapped to the
+    (resource, namespace, name, resource version) of the object it belongs to.
+    Combines with | like the booleans it replaces and is falsy when nothing changed.
+    """
+    __slots__ = (ADDED, MODIFIED, REMOVED)
+
+    def __init__(self, added=None, modified=None, removed=None):
+        self.added = added or {}
+        self.modified = modified or {}
+        self.removed = removed or {}
+
+    @classmethod
+    def of(cls, kind, path, resource, metadata):
+        changes = cls()
+        owner = (resource, metadata.namespace, metadata.name, metadata.resource_version)
+        getattr(changes, kind)[os.path.abspath(path)] = owner
+        return changes
+
+    def __bool__(self):
+        return bool(self.added or self.modified or self.removed)
+
+    def __len__(self):
+        return len(self.added) + len(self.modified) + len(self.removed)
+
+    def __ior__(self, other):
+        if not isinstance(other, FileChanges):
+            return self
+        # Apply the later changes on top of the earlier ones, e.g. a file added and removed again is no change
+        for path, owner in other.added.items():
+            if self.removed.pop(path, None) is not None:
+                self.modified[path] = owner
+            else:
+                self.added[path] = owner
+        for path, owner in other.modified.items():
+            if path in self.added:
+                self.added[path] = owner
+            else:
+                self.modified[path] = owner
+        for path, owner in other.removed.items():
+            if self.added.pop(path, None) is None:
+                self.modified.pop(path, None)
+                self.removed[path] = owner
+        return self
+
+    def __or__(self, other):
+        return FileChanges(dict(self.added), dict(self.modified), dict(self.removed)).__ior__(other)
+
+    def __ror__(self, other):
+        # other is a plain boolean of a function that reports no paths
+        return self.__or__(None)
+
+    def items(self):
+        """
+        Iterate over (kind, path, owner) of every change, sorted by path within each kind.
+        """
+        for kind in (ADDED, MODIFIED, REMOVED):
+            changes = getattr(self, kind)
+            for path in sorted(changes):
+                yield kind, path, changes[path]
+
+    def to_list(self):
+        return [{"path": path, "change": kind, "resource": resource, "namespace": namespace, "name": name,
+                 "resourceVersion": resource_version}
+                for kind, path, (resource, namespace, name, resource_version) in self.items()]
+
+    def digest(self):
+        """
+        A stable hash of the changes, which lets receivers of notifications drop duplicates.
+        """
+        return hashlib.sha256(json.dumps(self.to_list(), sort_keys=True).encode("utf-8")).hexdigest()
+
+    def status_lines(self):
+        """
+        Return one "<A|M|D> <path>" line per changed file.
+        """
+        return [f"{_STATUS_LETTERS[kind]} {changed_path}" for kind, changed_path, _ in self.items()]
+
+    def write_status_file(self):
+        """
+        Write the status lines of the changes into a temporary file and return its path.
+        """
+        fd, path = tempfile.mkstemp(prefix="k8s-sidecar-changes-", suffix=".txt")
+        with os.fdopen(fd, "w") as f:
+            for line in self.status_lines():
+                f.write(f"{line}\n")
+        return path
+
+
+class PayloadTemplate:
+    """
+    A request payload describing the changes that triggered the request. Every string of the (JSON) template
+    that consists of a single variable is replaced by its value, other strings get the variables substituted:
+
+    - ${changes}: list of {path, change, resource, namespace, name, resourceVersion}
+    - ${added}, ${modified}, ${removed}: lists of the paths changed that way
+    - ${count}: number of changed files
+    - ${digest}: SHA-256 of the changes, identical for identical notifications
+    """
+
+    def __init__(self, template):
+        self.template = template
+
+    def render(self, changes):
+        changes = changes or FileChanges()
+        variables = {
+            "changes": changes.to_list(),
+            "added": sorted(changes.added),
+            "modified": sorted(changes.modified),
+            "removed": sorted(changes.removed),
+            "count": len(changes),
+            "digest": changes.digest(),
+        }
+        return self._render(self.template, variables)
+
+    def _render(self, value, variables):
+        if isinstance(value, dict):
+            return {key: self._render(item, variables) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._render(item, variables) for item in value]
+        if isinstance(value, str):
+            if value.startswith("${") and value.endswith("}") and value[2:-1] in variables:
+                return variables[value[2:-1]]
+            return Template(value).safe_substitute(
+                {name: json.dumps(v) if isinstance(v, list) else v for name, v in variables.items()})
+        return value
+
+
+def render_payload(payload, changes):
+    """
+    Return the payload to send for the given FileChanges, rendering it if it is a PayloadTemplate.
+    """
+    if isinstance(payload, PayloadTemplate):
+        return payload.render(changes)
+    return payload
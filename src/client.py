@@ -15,12 +15,23 @@ logger = get_logger()
 SKIP_TLS_VERIFY = "SKIP_TLS_VERIFY"
 DISABLE_X509_STRICT_VERIFICATION = "DISABLE_X509_STRICT_VERIFICATION"
 
+# Unix socket of the node-level daemon (METHOD=DAEMON). Other methods read the objects from the daemon
+# listening there instead of the API server.
+DAEMON_SOCKET = os.getenv("DAEMON_SOCKET")
+
+
+def uses_daemon():
+    return bool(DAEMON_SOCKET) and os.getenv("METHOD") != "DAEMON"
+
 
 def _initialize_kubeclient_configuration():
     """
     Updates the default configuration of the kubernetes client. This is
     picked up later on automatically then.
     """
+    if uses_daemon():
+        # Only the daemon talks to the API server
+        return
 
     # this is where kube_config is going to look for a config file
     kube_config = os.path.expanduser(KUBE_CONFIG_DEFAULT_LOCATION)
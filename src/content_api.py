@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+import base64
+import hashlib
+import json
+import os
+import secrets
+from collections import deque, namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Thread
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from logger import get_logger
+
+# Port of the content API, serving the materialized files from memory. Unset disables it.
+CONTENT_API_PORT = os.getenv("CONTENT_API_PORT")
+# Only containers of the same pod can connect by default, the files may well contain secrets
+CONTENT_API_HOST = os.getenv("CONTENT_API_HOST", "127.0.0.1")
+# Longest time a /watch request waits for changes
+CONTENT_API_WATCH_TIMEOUT = float(os.getenv("CONTENT_API_WATCH_TIMEOUT", 30))
+# Removed files remembered for /watch, older cursors have to resync
+CONTENT_API_TOMBSTONES = int(os.getenv("CONTENT_API_TOMBSTONES", 1000))
+
+_Entry = namedtuple("_Entry", ("generation", "etag", "content", "resource", "namespace", "name"))
+
+# Get logger
+logger = get_logger()
+
+
+class Expired(Exception):
+    """
+    The cursor is from another process or older than the retained removals, the client has to resync.
+    """
+
+
+class ContentStore:
+    """
+    The content of every materialized file by absolute path, with the generation of its last change.
+    Every change increments the generation. Removed files are kept without content, so /watch can report them,
+    up to the last max_tombstones of them. Cursors combine the generation with the epoch of the process.
+    """
+
+    def __init__(self, max_tombstones=CONTENT_API_TOMBSTONES):
+        self.epoch = secrets.token_hex(8)
+        self.generation = 0
+        self.max_tombstones = max_tombstones
+        # Cursors before the last pruned removal can't be served anymore
+        self.low_water = 0
+        self._entries = {}
+        self._tombstones = deque()  # (generation, path) in the order of removal
+        self._condition = Condition()
+
+    def cursor(self, generation=None):
+        return f"{self.epoch}.{self.generation if generation is None else generation}"
+
+    def _parse_cursor(self, cursor):
+        epoch, _, generation = cursor.rpartition(".")
+        try:
+            generation = int(generation)
+        except ValueError:
+            raise Expired(f"Invalid cursor {cursor!r}")
+        if epoch != self.epoch or not self.low_water <= generation <= self.generation:
+            raise Expired(f"Cursor {cursor!r} has expired")
+        return generation
+
+    def publish(self, path, data, resource, metadata):
+        content = data.encode("utf-8") if isinstance(data, str) else data
+        etag = f'"{hashlib.sha256(content).hexdigest()}"'
+        with self._condition:
+            entry = self._entries.get(path)
+            if entry is not None and entry.etag == etag:
+                return
+            self.generation += 1
+            self._entries[path] = _Entry(self.generation, etag, content, resource, metadata.namespace, metadata.name)
+            self._condition.notify_all()
+
+    def withdraw(self, path):
+        with self._condition:
+            entry = self._entries.get(path)
+            if entry is None or entry.content is None:
+                return
+            self.generation += 1
+            self._entries[path] = entry._replace(generation=self.generation, etag=None, content=None)
+            self._tombstones.append((self.generation, path))
+            self._prune()
+            self._condition.notify_all()
+
+    def _prune(self):
+        while len(self._tombstones) > self.max_tombstones:
+            generation, path = self._tombstones.popleft()
+            self.low_water = generation
+            entry = self._entries.get(path)
+            # Files published again since are no tombstones anymore
+            if entry is not None and entry.generation == generation:
+                del self._entries[path]
+
+    def get(self, path):
+        with self._condition:
+            entry = self._entries.get(path)
+            return entry if entry is not None and entry.content is not None else None
+
+    def files(self):
+        with self._condition:
+            return self.cursor(), {path: entry for path, entry in self._entries.items() if entry.content is not None}
+
+    def changes_since(self, cursor, timeout):
+        """
+        Wait up to timeout for a change after cursor and return the current cursor with the entries changed
+        after it. Without a cursor, the current files are returned right away. Raises Expired if the changes
+        after cursor are not known anymore.
+        """
+        if cursor is None:
+            return self.files()
+        with self._condition:
+            since = self._parse_cursor(cursor)
+            self._condition.wait_for(lambda: self.generation > since, timeout)
+            # Removals after since may have been pruned while waiting
+            if since < self.low_water:
+                raise Expired(f"Cursor {cursor!r} has expired")
+            return self.cursor(), {path: entry for path, entry in self._entries.items() if entry.generation > since}
+
+
+_store = None
+
+
+def _describe(path, entry, with_content=False):
+    description = {"path": path, "generation": entry.generation}
+    if entry.content is None:
+        description["change"] = "removed"
+        return description
+    description.update(change="modified", etag=entry.etag, size=len(entry.content), resource=entry.resource,
+                       namespace=entry.namespace, name=entry.name)
+    if with_content:
+        try:
+            description["content"] = entry.content.decode("utf-8")
+        except UnicodeDecodeError:
+            description["contentBase64"] = base64.b64encode(entry.content).decode("ascii")
+    return description
+
+
+class ContentHandler(BaseHTTPRequestHandler):
+    """
+    GET /content lists the files, GET /content/<absolute path> returns one of them and
+    GET /watch?since=<cursor> waits for the files changed after that cursor.
+    """
+    server_version = "ContentHTTP/1.0"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/content":
+            self._send_listing()
+        elif url.path.startswith("/content/"):
+            self._send_file(unquote(url.path[len("/content"):]))
+        elif url.path == "/watch":
+            try:
+                timeout = min(float(query.get("timeout", [CONTENT_API_WATCH_TIMEOUT])[0]), CONTENT_API_WATCH_TIMEOUT)
+            except ValueError:
+                self._send(400, b"timeout must be a number")
+                return
+            self._send_changes(query.get("since", [None])[0], timeout, query.get("content", ["false"])[0] == "true")
+        else:
+            self._send(404, b"Not Found")
+
+    def _send_listing(self):
+        cursor, files = _store.files()
+        etag = f'"{cursor}"'
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304, b"", etag=etag, cursor=cursor)
+            return
+        body = {"cursor": cursor, "files": [_describe(path, entry) for path, entry in sorted(files.items())]}
+        self._send(200, json.dumps(body).encode("utf-8"), "application/json", etag, cursor)
+
+    def _send_file(self, path):
+        entry = _store.get(path)
+        if entry is None:
+            self._send(404, b"Not Found")
+        elif self.headers.get("If-None-Match") == entry.etag:
+            self._send(304, b"", etag=entry.etag, cursor=_store.cursor(entry.generation))
+        else:
+            self._send(200, entry.content, "application/octet-stream", entry.etag, _store.cursor(entry.generation))
+
+    def _send_changes(self, since, timeout, with_content):
+        try:
+            cursor, changes = _store.changes_since(since, timeout)
+        except Expired as e:
+            # The client has to start over with GET /watch without since, or GET /content
+            self._send(410, str(e).encode("utf-8"))
+            return
+        body = {"cursor": cursor,
+                "changes": [_describe(path, entry, with_content) for path, entry in sorted(changes.items())]}
+        self._send(200, json.dumps(body).encode("utf-8"), "application/json", cursor=cursor)
+
+    def _send(self, status, body, content_type="text/plain; charset=utf-8", etag=None, cursor=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+        if cursor is not None:
+            self.send_header("X-Cursor", cursor)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Content API: " + format, *args)
+
+
+def start_content_api():
+    """
+    Start serving the materialized files on CONTENT_API_PORT in a background thread, if it is set.
+    Returns the store to publish the files to.
+    """
+    global _store
+    if not CONTENT_API_PORT:
+        return None
+    _store = ContentStore()
+    server = ThreadingHTTPServer((CONTENT_API_HOST, int(CONTENT_API_PORT)), ContentHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="content-api", daemon=True).start()
+    logger.info(f"Serving the materialized files on {CONTENT_API_HOST}:{CONTENT_API_PORT}")
+    return _store
@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+
+import json
+import os
+import socket
+import socketserver
+import sys
+from collections import deque
+from itertools import islice
+from threading import Condition, Thread
+from time import monotonic, sleep, time_ns
+from types import SimpleNamespace
+
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from kubernetes.watch.watch import iter_resp_lines
+
+from client import DAEMON_SOCKET, _initialize_kubeclient_configuration, get_api_client
+from healthz import mark_ready, register_watcher, register_watcher_processes, set_watchers_alive, update_k8s_contact
+from helpers import WATCH_CLIENT_TIMEOUT, WATCH_SERVER_TIMEOUT
+from label_selectors import ALTERNATIVES_SEPARATOR, compile_label_selector
+from logger import get_logger
+from ratelimit import jittered, rate_limited
+from records import ResourceRecord
+from resources import (INITIAL_EVENTS_END_ANNOTATION, RESOURCE_CONFIGMAP, RESOURCE_SECRET, _list_namespace,
+                       _selectors)
+
+# Number of changes the daemon keeps to resume the watches of clients, older resource versions are gone (410)
+DAEMON_HISTORY = int(os.getenv("DAEMON_HISTORY", 10000))
+# Permissions of the socket. Every process that can connect reads the served objects, secrets included.
+DAEMON_SOCKET_MODE = int(os.getenv("DAEMON_SOCKET_MODE", "660"), base=8)
+# Seconds a request waits for the first list of its informer before the daemon answers 503
+DAEMON_SYNC_TIMEOUT = float(os.getenv("DAEMON_SYNC_TIMEOUT", 30))
+# Seconds a sidecar waits for data from the daemon, unless the request sets its own timeout
+DAEMON_CLIENT_TIMEOUT = float(os.getenv("DAEMON_CLIENT_TIMEOUT", 66))
+
+# Get logger
+logger = get_logger()
+
+
+class ObjectCache:
+    """
+    The objects of all informers of the daemon and a bounded history of their changes. Every change gets the
+    next sequence number, which clients see as the resource version of lists, watches and bookmarks.
+    """
+
+    def __init__(self, history):
+        # Resource versions of a previous daemon are rejected, sequence numbers start over with every process
+        self.epoch = str(time_ns())
+        self._objects = {}  # (resource, namespace, name) -> object as sent by the API server
+        self._events = deque(maxlen=history)  # (sequence number, event type, resource, object, previous object)
+        self._seq = 0
+        self._synced = set()  # (resource, namespace) of the informers that completed their first list
+        self._condition = Condition()
+
+    def resource_version(self, seq):
+        return f"{self.epoch}-{seq}"
+
+    def _parse_resource_version(self, resource_version):
+        epoch, _, seq = str(resource_version).partition("-")
+        return int(seq) if epoch == self.epoch and seq.isdigit() else None
+
+    def _apply(self, resource, event_type, obj):
+        metadata = obj.get("metadata") or {}
+        key = (resource, metadata.get("namespace"), metadata.get("name"))
+        previous = self._objects.get(key)
+        if event_type == "DELETED":
+            if previous is None:
+                return
+            del self._objects[key]
+        else:
+            if previous is not None and previous["metadata"].get("resourceVersion") == metadata.get("resourceVersion"):
+                return
+            event_type = "ADDED" if previous is None else "MODIFIED"
+            self._objects[key] = obj
+        self._seq += 1
+        self._events.append((self._seq, event_type, resource, obj, previous))
+        self._condition.notify_all()
+
+    def apply(self, resource, event_type, obj):
+        with self._condition:
+            self._apply(resource, event_type, obj)
+
+    def replace(self, resource, namespace, objects):
+        """
+        Apply the result of a list, objects missing from it were deleted while the informer was not watching.
+        """
+        with self._condition:
+            listed = set()
+            for obj in objects:
+                listed.add((resource, obj["metadata"]["namespace"], obj["metadata"]["name"]))
+                self._apply(resource, "ADDED", obj)
+            for key in [key for key in self._objects
+                        if key[0] == resource and namespace in ("ALL", key[1]) and key not in listed]:
+                self._apply(resource, "DELETED", self._objects[key])
+            self._synced.add((resource, namespace))
+            self._condition.notify_all()
+
+    def wait_synced(self, resource, namespace, timeout=None):
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: (resource, "ALL") in self._synced or (resource, namespace) in self._synced, timeout)
+
+    def get(self, resource, namespace, name):
+        with self._condition:
+            return self._objects.get((resource, namespace, name))
+
+    def snapshot(self, resource, namespace, matcher):
+        """
+        Return the matching objects and the sequence number they are current at.
+        """
+        with self._condition:
+            objects = [obj for (r, ns, _), obj in self._objects.items()
+                       if r == resource and namespace in ("ALL", ns)
+                       and matcher(obj["metadata"].get("labels") or {})]
+            return objects, self._seq
+
+    def changes_since(self, resource_version, timeout):
+        """
+        Wait up to timeout for changes after the resource version and return them with the sequence number
+        they reach. Returns None if the resource version is unknown or no longer in the history.
+        """
+        seq = self._parse_resource_version(resource_version)
+        with self._condition:
+            if seq is None or seq > self._seq:
+                return None
+            self._condition.wait_for(lambda: self._seq > seq, timeout)
+            if seq == self._seq:
+                return [], seq
+            first = self._events[0][0] if self._events else self._seq + 1
+            if seq + 1 < first:
+                return None
+            return list(islice(self._events, seq + 1 - first, None)), self._seq
+
+
+class _Informer:
+    """
+    Keeps the cache of one resource and namespace up to date: a list, then watches resumed from the last
+    resource version, and a new list whenever that version expired.
+    """
+
+    def __init__(self, cache, v1, resource, namespace, label_selector, matcher):
+        self.cache = cache
+        self.resource = resource
+        self.namespace = namespace
+        self.matcher = matcher
+        self.list_fn = getattr(v1, _list_namespace[namespace][resource])
+        self.args = _selectors(resource, None, None, label_selector)
+        if not label_selector:
+            del self.args['label_selector']
+        if namespace != "ALL":
+            self.args['namespace'] = namespace
+        self.heartbeat = register_watcher(f"daemon/{namespace}/{resource}")
+        self.thread = Thread(target=self._run, name=f"daemon-{namespace}-{resource}", daemon=True)
+
+    def _run(self):
+        first_run = True
+        while True:
+            if not first_run:
+                self.heartbeat.reconnected()
+            first_run = False
+            try:
+                resource_version = self._list()
+                while True:
+                    resource_version = self._watch(resource_version)
+            except ApiException as e:
+                self.heartbeat.errors += 1
+                if e.status == 410:
+                    logger.info(f"Watch of {self.namespace}/{self.resource} expired, listing again")
+                    continue
+                logger.error(f"ApiException when calling kubernetes: {e}\n")
+            except Exception as e:
+                self.heartbeat.errors += 1
+                logger.error(f"Daemon informer of {self.namespace}/{self.resource} failed: {e}\n")
+            sleep(jittered(int(os.getenv("ERROR_THROTTLE_SLEEP", 5))))
+
+    def _list(self):
+        objects = []
+        continue_token = None
+        while True:
+            resp = self.list_fn(limit=500, _continue=continue_token, _preload_content=False, **self.args)
+            content = json.loads(resp.data)
+            objects.extend(content.get("items") or ())
+            metadata = content.get("metadata") or {}
+            continue_token = metadata.get("continue")
+            if not continue_token:
+                break
+        self.heartbeat.event_received()
+        self.cache.replace(self.resource, self.namespace,
+                           [obj for obj in objects if self.matcher((obj.get("metadata") or {}).get("labels") or {})])
+        self.heartbeat.event_processed()
+        logger.info(f"Daemon cached {len(objects)} {self.resource} objects of {self.namespace}")
+        return metadata.get("resourceVersion")
+
+    def _watch(self, resource_version):
+        resp = self.list_fn(watch=True, _preload_content=False, resource_version=resource_version,
+                            allow_watch_bookmarks=True, timeout_seconds=WATCH_SERVER_TIMEOUT,
+                            _request_timeout=WATCH_CLIENT_TIMEOUT, **self.args)
+        try:
+            for line in iter_resp_lines(resp):
+                if not line:
+                    continue
+                event = json.loads(line)
+                event_type = event.get("type")
+                obj = event.get("object") or {}
+                if event_type == "ERROR":
+                    raise ApiException(status=obj.get("code"), reason=f"{obj.get('reason')}: {obj.get('message')}")
+                self.heartbeat.event_received()
+                resource_version = (obj.get("metadata") or {}).get("resourceVersion") or resource_version
+                if event_type != "BOOKMARK":
+                    # With several label selectors the daemon watches everything and filters itself
+                    if event_type != "DELETED" and not self.matcher((obj.get("metadata") or {}).get("labels") or {}):
+                        event_type = "DELETED"
+                    self.cache.apply(self.resource, event_type, obj)
+                self.heartbeat.event_processed()
+        finally:
+            resp.close()
+            resp.release_conn()
+        update_k8s_contact()
+        return resource_version
+
+
+def _status(code, message):
+    return {"kind": "Status", "status": "Failure", "code": code, "reason": message, "message": message}
+
+
+class _DaemonRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Serves one request of newline-delimited JSON: {"verb": "list"|"watch"|"get", "resource", "namespace",
+    "name", "labelSelector", "resourceVersion", "sendInitialEvents", "timeoutSeconds"}. Responses have the
+    shape of the API server's: a list or object, a Status on errors and one event per line for watches.
+    """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline() or b"{}")
+            self._handle(request)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except ValueError as e:
+            self._send(_status(400, f"Invalid request: {e}"))
+
+    def _send(self, content):
+        self.wfile.write(json.dumps(content).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+    def _handle(self, request):
+        cache = self.server.cache
+        verb = request.get("verb")
+        resource = request.get("resource")
+        namespace = request.get("namespace") or "ALL"
+        if resource not in self.server.resources or (
+                "ALL" not in self.server.namespaces and namespace not in self.server.namespaces):
+            status = _status(403, f"{resource} of namespace {namespace} are not served by this daemon")
+            self._send({"type": "ERROR", "object": status} if verb == "watch" else status)
+            return
+        if not cache.wait_synced(resource, namespace, DAEMON_SYNC_TIMEOUT):
+            status = _status(503, f"Daemon has not synced {resource} of namespace {namespace} yet")
+            self._send({"type": "ERROR", "object": status} if verb == "watch" else status)
+            return
+
+        if verb == "get":
+            obj = cache.get(resource, namespace, request.get("name"))
+            self._send(obj if obj is not None else _status(404, f"{resource} {request.get('name')} not found"))
+        elif verb == "list":
+            objects, seq = cache.snapshot(resource, namespace, _matcher(request.get("labelSelector")))
+            self._send({"kind": "List", "metadata": {"resourceVersion": cache.resource_version(seq)},
+                        "items": objects})
+        elif verb == "watch":
+            self._watch(request, resource, namespace)
+        else:
+            self._send(_status(400, f"Unknown verb {verb}"))
+
+    def _watch(self, request, resource, namespace):
+        cache = self.server.cache
+        matcher = _matcher(request.get("labelSelector"))
+        deadline = monotonic() + float(request["timeoutSeconds"]) if request.get("timeoutSeconds") else None
+        resource_version = request.get("resourceVersion")
+        if not resource_version or request.get("sendInitialEvents"):
+            objects, seq = cache.snapshot(resource, namespace, matcher)
+            resource_version = cache.resource_version(seq)
+            for obj in objects:
+                self._send({"type": "ADDED", "object": obj})
+            if request.get("sendInitialEvents"):
+                self._send({"type": "BOOKMARK", "object": {"metadata": {
+                    "resourceVersion": resource_version,
+                    "annotations": {INITIAL_EVENTS_END_ANNOTATION: "true"}}}})
+
+        while deadline is None or monotonic() < deadline:
+            timeout = 5 if deadline is None else min(5, max(0, deadline - monotonic()))
+            changes = cache.changes_since(resource_version, timeout)
+            if changes is None:
+                self._send({"type": "ERROR", "object": _status(410, f"Resource version {resource_version} is gone")})
+                return
+            events, seq = changes
+            resource_version = cache.resource_version(seq)
+            for _, event_type, event_resource, obj, previous in events:
+                if event_resource != resource or namespace not in ("ALL", obj["metadata"].get("namespace")):
+                    continue
+                # Like the API server, an object entering or leaving the selection is added or deleted
+                matches = event_type != "DELETED" and matcher(obj["metadata"].get("labels") or {})
+                matched = previous is not None and matcher(previous["metadata"].get("labels") or {})
+                if matches:
+                    self._send({"type": "MODIFIED" if matched else "ADDED", "object": obj})
+                elif matched:
+                    self._send({"type": "DELETED", "object": obj})
+
+
+class _DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _matcher(label_selector):
+    """
+    Match labels against a label selector, or any of the alternatives of LABEL_SELECTOR.
+    """
+    if not label_selector:
+        return lambda labels: True
+    matchers = [compile_label_selector(selector) for selector in label_selector.split(ALTERNATIVES_SEPARATOR)]
+    return lambda labels: any(matcher(labels) for matcher in matchers)
+
+
+def start_daemon_server(path, cache, resources, namespaces):
+    """
+    Serve the cache of the given resources and namespaces on the Unix socket at path, in a background thread.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    server = _DaemonServer(path, _DaemonRequestHandler)
+    os.chmod(path, DAEMON_SOCKET_MODE)
+    server.cache = cache
+    server.resources = set(resources)
+    server.namespaces = set(namespaces)
+    Thread(target=server.serve_forever, name="daemon-server", daemon=True).start()
+    logger.info(f"Daemon serving {', '.join(resources)} of {', '.join(namespaces)} on {path}")
+    return server
+
+
+def serve_daemon(resources, namespaces, label_selectors):
+    """
+    Run the node-level daemon: a single cache of the selected objects, served to the sidecars of the node
+    over DAEMON_SOCKET. Never returns.
+    """
+    _initialize_kubeclient_configuration()
+    v1 = rate_limited(client.CoreV1Api(api_client=get_api_client()))
+    cache = ObjectCache(DAEMON_HISTORY)
+
+    # A single selector is applied by the API server, several ones by the daemon on everything it watches
+    label_selector = label_selectors[0] if len(label_selectors) == 1 else None
+    matcher = _matcher(ALTERNATIVES_SEPARATOR.join(label_selectors) if len(label_selectors) > 1 else None)
+    informers = [_Informer(cache, v1, resource, namespace, label_selector, matcher)
+                 for resource in resources for namespace in namespaces]
+    for informer in informers:
+        informer.thread.start()
+    register_watcher_processes([informer.thread for informer in informers])
+
+    start_daemon_server(DAEMON_SOCKET, cache, resources, namespaces)
+
+    for informer in informers:
+        cache.wait_synced(informer.resource, informer.namespace)
+    mark_ready()
+    logger.info("Daemon cache synced, daemon is ready.")
+
+    while True:
+        update_k8s_contact()
+        alive = all(informer.thread.is_alive() for informer in informers)
+        set_watchers_alive(alive)
+        if not alive:
+            logger.fatal("A daemon informer died. Exiting")
+            sys.exit(1)
+        sleep(5)
+
+
+class _DaemonResponse:
+    """
+    The daemon's answer on a connection, with the parts of a urllib3 response used by the watch code.
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._file = sock.makefile("rb")
+
+    def readline(self):
+        return self._file.readline()
+
+    def stream(self, amt=None, decode_content=False):
+        for line in self._file:
+            yield line
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def release_conn(self):
+        pass
+
+
+def _raise_for_status(content):
+    if content.get("kind") == "Status":
+        raise ApiException(status=content.get("code"), reason=content.get("message"))
+
+
+class DaemonApi:
+    """
+    Stand-in for CoreV1Api reading the objects from the daemon at DAEMON_SOCKET instead of the API server.
+    Label selectors are applied by the daemon, field selectors are those the daemon was started with.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or DAEMON_SOCKET
+
+    def _request(self, request, request_timeout=None):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Like urllib3, a tuple is (connect, read) timeout, the read timeout applies to every read
+        if isinstance(request_timeout, tuple):
+            request_timeout = request_timeout[-1]
+        sock.settimeout(float(request_timeout) if request_timeout is not None else DAEMON_CLIENT_TIMEOUT)
+        try:
+            sock.connect(self.path)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        except OSError:
+            sock.close()
+            raise
+        return _DaemonResponse(sock)
+
+    def _list(self, resource, namespace, watch=False, label_selector=None, resource_version=None,
+              send_initial_events=None, timeout_seconds=None, _preload_content=True, _request_timeout=None,
+              **kwargs):
+        response = self._request({
+            "verb": "watch" if watch else "list",
+            "resource": resource,
+            "namespace": namespace,
+            "labelSelector": label_selector or None,
+            "resourceVersion": resource_version or None,
+            "sendInitialEvents": bool(send_initial_events),
+            "timeoutSeconds": int(timeout_seconds) if timeout_seconds else None,
+        }, _request_timeout)
+        if watch:
+            return response
+        try:
+            data = response.readline()
+        finally:
+            response.close()
+        content = json.loads(data)
+        _raise_for_status(content)
+        if not _preload_content:
+            return SimpleNamespace(data=data)
+        return SimpleNamespace(items=[ResourceRecord.from_dict(obj) for obj in content.get("items") or ()],
+                               metadata=SimpleNamespace(_continue=None,
+                                                        resource_version=content["metadata"]["resourceVersion"]))
+
+    def _read(self, resource, name, namespace, _request_timeout=None, **kwargs):
+        response = self._request({"verb": "get", "resource": resource, "namespace": namespace, "name": name},
+                                 _request_timeout)
+        try:
+            content = json.loads(response.readline())
+        finally:
+            response.close()
+        _raise_for_status(content)
+        return ResourceRecord.from_dict(content)
+
+    # watch.Watch().stream() reads the type of the events from the :return: line of the docstring, newer
+    # clients also from the return annotation
+    def list_namespaced_config_map(self, namespace, **kwargs) -> client.V1ConfigMapList:
+        """
+        :return: V1ConfigMapList
+        """
+        return self._list(RESOURCE_CONFIGMAP, namespace, **kwargs)
+
+    def list_config_map_for_all_namespaces(self, **kwargs) -> client.V1ConfigMapList:
+        """
+        :return: V1ConfigMapList
+        """
+        return self._list(RESOURCE_CONFIGMAP, "ALL", **kwargs)
+
+    def list_namespaced_secret(self, namespace, **kwargs) -> client.V1SecretList:
+        """
+        :return: V1SecretList
+        """
+        return self._list(RESOURCE_SECRET, namespace, **kwargs)
+
+    def list_secret_for_all_namespaces(self, **kwargs) -> client.V1SecretList:
+        """
+        :return: V1SecretList
+        """
+        return self._list(RESOURCE_SECRET, "ALL", **kwargs)
+
+    def read_namespaced_config_map(self, name, namespace, **kwargs) -> client.V1ConfigMap:
+        """
+        :return: V1ConfigMap
+        """
+        return self._read(RESOURCE_CONFIGMAP, name, namespace, **kwargs)
+
+    def read_namespaced_secret(self, name, namespace, **kwargs) -> client.V1Secret:
+        """
+        :return: V1Secret
+        """
+        return self._read(RESOURCE_SECRET, name, namespace, **kwargs)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import select
+import struct
+from threading import Event, Lock, Thread
+
+from logger import get_logger
+
+# Repair target files that were modified or deleted by someone else from the cached objects
+DRIFT_REPAIR = os.getenv("DRIFT_REPAIR", "false").lower() == "true"
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+# Every owned file, path -> (SHA-256 digest of the content last written, whatever rebuilds it)
+_sources = {}
+# Locks held while an owned file is written, so a repair never races with an update of the same file.
+# Paths are spread over a fixed number of locks, writes of different files rarely wait for each other.
+_file_locks = [Lock() for _ in range(64)]
+
+_inotify = None
+
+# Get logger
+logger = get_logger()
+
+
+class _Inotify:
+    """
+    Minimal ctypes binding of inotify(7), watching the directories of the owned files.
+    """
+
+    def __init__(self):
+        # ctypes is only needed with DRIFT_REPAIR
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._get_errno = ctypes.get_errno
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}  # watch descriptor -> directory
+        self.wds = {}  # directory -> watch descriptor
+
+    def watch(self, directory):
+        if directory in self.wds:
+            return
+        wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            logger.warning(f"Unable to watch {directory} for drift: {os.strerror(self._get_errno())}")
+            return
+        self.dirs[wd] = directory
+        self.wds[directory] = wd
+
+    def read_events(self):
+        """
+        Return the (mask, path) of every pending event, paths of the directory itself for directory events.
+        """
+        buffer = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b"\0")
+            offset += length
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                # The directory itself is gone
+                del self.dirs[wd]
+                self.wds.pop(directory, None)
+            events.append((mask, os.path.join(directory, os.fsdecode(name)) if name else directory))
+        return events
+
+
+def file_lock(path):
+    return _file_locks[hash(path) % len(_file_locks)]
+
+
+def _digest(data):
+    return hashlib.sha256(data.encode("utf-8") if isinstance(data, str) else data).hexdigest()
+
+
+def _file_digest(path):
+    sha256_hash = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for byte_block in iter(lambda: f.read(4096), b""):
+                sha256_hash.update(byte_block)
+    except OSError:
+        return None
+    return sha256_hash.hexdigest()
+
+
+def track_file(path, data, source):
+    """
+    Remember the content written to an owned file and the source to rebuild it from. Must be called with
+    the file_lock of the path held, together with the write.
+    """
+    _sources[path] = (_digest(data), source)
+    if _inotify is not None:
+        _inotify.watch(os.path.dirname(path))
+
+
+def untrack_file(path):
+    _sources.pop(path, None)
+
+
+class DriftRepairer:
+    """
+    Watches the directories of the owned files and rewrites a file from its tracked source whenever
+    it is changed, replaced or deleted, without going through the API server or rescanning the folder.
+    Writes of the sidecar itself trigger events too, they are ignored as the file matches the tracked digest.
+    """
+
+    def __init__(self, repair_fn, inotify):
+        self.repair_fn = repair_fn
+        self.inotify = inotify
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="drift-repair", daemon=True)
+
+    def start(self):
+        for path in list(_sources):
+            self.inotify.watch(os.path.dirname(path))
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self.inotify.fd], [], [], 1)
+            if not readable or self._stop.is_set():
+                continue
+            try:
+                paths = set()
+                for mask, path in self.inotify.read_events():
+                    if mask & (IN_DELETE_SELF | IN_IGNORED):
+                        paths.update(p for p in list(_sources) if os.path.dirname(p) == path)
+                    else:
+                        paths.add(path)
+                for path in sorted(paths):
+                    self._repair(path)
+            except Exception:
+                logger.exception("Drift repair failed")
+
+    def _repair(self, path):
+        with file_lock(path):
+            tracked = _sources.get(path)
+            if tracked is None:
+                return
+            digest, source = tracked
+            if _file_digest(path) != digest and self.repair_fn(path, source):
+                logger.warning(f"Repaired {path}, it was changed or deleted outside of the sidecar")
+            self.inotify.watch(os.path.dirname(path))
+
+
+_repairer = None
+
+
+def start_drift_repair(repair_fn):
+    """
+    Start repairing drifted files with repair_fn(path, source), which returns whether it rewrote the file
+    and tracks the content it wrote.
+    """
+    global _inotify, _repairer
+    try:
+        _inotify = _Inotify()
+    except (OSError, AttributeError) as e:
+        logger.error(f"Drift repair is not available on this system: {e}")
+        return False
+    _repairer = DriftRepairer(repair_fn, _inotify)
+    _repairer.start()
+    logger.info("Repairing drift of owned files")
+    return True
+
+
+def is_repairing():
+    return _repairer is not None
+
+
+def stop_drift_repair():
+    """
+    Stop repairing and tracking files, e.g. before forking worker processes which would each hold a stale copy.
+    """
+    global _inotify, _repairer
+    if _repairer is not None:
+        _repairer.stop()
+        _repairer = None
+        _inotify = None
+        _sources.clear()
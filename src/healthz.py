@@ -1,23 +1,99 @@
+import fnmatch
 import ipaddress
+import json
 import logging
-import logging.config
 import os
 import socket
 import threading
-from datetime import datetime, timedelta, timezone
+import time
+from collections import Counter
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from threading import Thread
-from typing import List
+from typing import TYPE_CHECKING, Dict, List, Union
+from urllib.parse import parse_qs, urlsplit
 
-from logger import get_log_config
+from logger import configure_logging, get_log_config, get_logger
 
-# Health state variables
+if TYPE_CHECKING:
+    from multiprocessing.process import BaseProcess
+
+# Health state variables, timestamps are taken from the monotonic clock
 is_ready = False
-last_k8s_contact = datetime.now(timezone.utc)
-watcher_processes: List[Thread] = []
+last_k8s_contact = time.monotonic()
+watcher_processes: List[Union[Thread, "BaseProcess"]] = []
+watchers_alive = True
+# Objects and keys skipped by the guardrails, by reason
+skipped = Counter()
+_skipped_lock = threading.Lock()
+
+# Initial sync progress, by "namespace/resource", and the scopes each pipeline reads from
+sync_scopes: Dict[str, dict] = {}
+sync_pipelines: Dict[str, List[str]] = {}
+_sync_lock = threading.Lock()
+_started = time.monotonic()
+ready_after_seconds = None
 
 # Settings
 K8S_CONTACT_THRESHOLD_SECONDS = 60  # tolerated delay before declaring not live
+# What must be synced for readiness: "all" of the initial sync, or "namespace/resource" globs and "pipeline:<name>"
+READY_WHEN = [condition.strip() for condition in os.getenv("READY_WHEN", "all").split(",") if condition.strip()]
+
+logger = get_logger()
+
+
+class WatcherHeartbeat:
+    """
+    Liveness slot of a single watcher. Only the owning watcher thread writes to it,
+    the health server just reads the values.
+    """
+    __slots__ = ("name", "last_event", "events_received", "events_processed", "reconnects", "errors",
+                 "busy_since")
+
+    def __init__(self, name):
+        self.name = name
+        self.last_event = None
+        self.events_received = 0
+        self.events_processed = 0
+        self.reconnects = 0
+        self.errors = 0
+        self.busy_since = None
+
+    def event_received(self):
+        """
+        Record an event from Kubernetes, which also counts as Kubernetes contact.
+        """
+        global last_k8s_contact
+        now = time.monotonic()
+        self.last_event = now
+        self.busy_since = now
+        self.events_received += 1
+        last_k8s_contact = now
+
+    def event_processed(self):
+        self.events_processed += 1
+        self.busy_since = None
+
+    def reconnected(self):
+        """
+        Record a new connection to Kubernetes. Events of the previous connection that were
+        never processed (e.g. because of an error) are dropped from the backlog.
+        """
+        self.reconnects += 1
+        self.events_processed = self.events_received
+        self.busy_since = None
+
+    def details(self, now):
+        return {
+            "last_event_age_seconds": round(now - self.last_event, 3) if self.last_event is not None else None,
+            "events": self.events_received,
+            "backlog": self.events_received - self.events_processed,
+            "busy_seconds": round(now - self.busy_since, 3) if self.busy_since is not None else None,
+            "reconnects": self.reconnects,
+            "errors": self.errors,
+        }
+
+
+watcher_heartbeats: Dict[str, WatcherHeartbeat] = {}
 
 
 class HealthCheckFilter(logging.Filter):
@@ -32,47 +108,43 @@ class HealthHandler(BaseHTTPRequestHandler):
     server_version = "HealthHTTP/1.0"
 
     def do_GET(self):
-        global is_ready, last_k8s_contact, watcher_processes
-
-        if self.path != "/healthz":
-            self.send_response(404)
-            self.send_header("Content-Type", "text/plain; charset=utf-8")
-            body = "Not Found"
-            self.send_header("Content-Length", str(len(body)))
-            self.end_headers()
-            self.wfile.write(body.encode("utf-8"))
+        url = urlsplit(self.path)
+        if url.path == "/debug/profile":
+            self._send_profile()
+            return
+        if url.path != "/healthz":
+            self._send(404, "Not Found")
             return
 
-        now = datetime.now(timezone.utc)
-
-        # Readiness check
-        if not is_ready:
-            status = 503
-            body = "NOT READY"
-        # Liveness check (k8s contact)
-        elif (now - last_k8s_contact) > timedelta(
-                seconds=K8S_CONTACT_THRESHOLD_SECONDS
-        ):
-            status = 503
-            body = "NOT LIVE (K8s contact lost)"
-        # Liveness check (watcher processes)
-        elif watcher_processes and not all(p.is_alive() for p in watcher_processes):
-            status = 503
-            body = "NOT LIVE (watcher thread died)"
+        status, body = _health_status()
+        if "verbose" in parse_qs(url.query, keep_blank_values=True):
+            self._send(status, json.dumps(_health_details(body)), "application/json")
+        else:
+            self._send(status, body)
+
+    def _send_profile(self):
+        # Imported on demand, the sidecar only loads the profiler at startup with PROFILE=true
+        from profiler import get_report, is_profiling
+        report = get_report()
+        if report is not None:
+            self._send(200, report)
+        elif is_profiling():
+            self._send(202, "PROFILING")
         else:
-            status = 200
-            body = "OK"
+            self._send(404, "No profile recorded, set PROFILE=true")
 
+    def _send(self, status, body, content_type="text/plain; charset=utf-8"):
+        body = body.encode("utf-8")
         self.send_response(status)
-        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Type", content_type)
         self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        self.wfile.write(body.encode("utf-8"))
+        self.wfile.write(body)
 
     # Avoid noisy default stderr logging; push to logging module instead
     def log_message(self, format: str, *args):
         # Skip logging /healthz entirely, or you can route it through the filter
-        if self.path == "/healthz":
+        if urlsplit(self.path).path == "/healthz":
             return
 
         logger = logging.getLogger("health_server.access")
@@ -84,29 +156,134 @@ class HealthHandler(BaseHTTPRequestHandler):
             )
 
 
+def _health_status():
+    # Readiness check
+    if not is_ready:
+        return 503, "NOT READY"
+    # Liveness check (k8s contact)
+    if time.monotonic() - last_k8s_contact > K8S_CONTACT_THRESHOLD_SECONDS:
+        return 503, "NOT LIVE (K8s contact lost)"
+    # Liveness check (watcher processes), kept up to date by the watcher supervisor
+    if not watchers_alive:
+        return 503, "NOT LIVE (watcher thread died)"
+    return 200, "OK"
+
+
+def _health_details(status):
+    now = time.monotonic()
+    return {
+        "status": status,
+        "ready": is_ready,
+        "last_k8s_contact_age_seconds": round(now - last_k8s_contact, 3),
+        "watcher_processes": {getattr(p, "name", str(p)): p.is_alive() for p in watcher_processes},
+        "watchers": {name: heartbeat.details(now) for name, heartbeat in list(watcher_heartbeats.items())},
+        "skipped": dict(skipped),
+        "sync": _sync_details(),
+    }
+
+
+def _sync_details():
+    with _sync_lock:
+        return {
+            "progress": f"{sum(scope['synced'] for scope in sync_scopes.values())}/{len(sync_scopes)}",
+            "ready_after_seconds": ready_after_seconds,
+            "scopes": {name: dict(scope) for name, scope in sync_scopes.items()},
+            "pipelines": {name: all(sync_scopes[scope]["synced"] for scope in scopes)
+                          for name, scopes in sync_pipelines.items()},
+        }
+
+
+def is_ready_scope(name: str) -> bool:
+    """
+    Check whether READY_WHEN waits for the "namespace/resource" scope, so it can be synced first.
+    """
+    for condition in READY_WHEN:
+        if condition.startswith("pipeline:"):
+            if name in sync_pipelines.get(condition[len("pipeline:"):], ()):
+                return True
+        elif condition != "all" and fnmatch.fnmatchcase(name, condition):
+            return True
+    return False
+
+
+def _ready_policy_met():
+    if "all" in READY_WHEN:
+        return False
+    required = [scope for name, scope in sync_scopes.items() if is_ready_scope(name)]
+    return bool(required) and all(scope["synced"] for scope in required)
+
+
 # Public helper functions
 
 def mark_ready():
     """
     Mark the sidecar as ready (initial sync done).
     """
-    global is_ready
+    global is_ready, ready_after_seconds
+    if not is_ready:
+        ready_after_seconds = round(time.monotonic() - _started, 3)
     is_ready = True
 
+def register_sync_scope(name: str):
+    """
+    Declare a "namespace/resource" of the initial sync, so its progress is tracked.
+    """
+    with _sync_lock:
+        sync_scopes[name] = {"synced": False, "synced_after_seconds": None}
+
+def register_sync_pipeline(name: str, scopes: List[str]):
+    with _sync_lock:
+        sync_pipelines[name] = list(scopes)
+
+def mark_synced(name: str):
+    """
+    Record the initial sync of a "namespace/resource" as done, which makes the sidecar ready
+    once everything READY_WHEN waits for is synced.
+    """
+    with _sync_lock:
+        sync_scopes[name] = {"synced": True, "synced_after_seconds": round(time.monotonic() - _started, 3)}
+        policy_met = not is_ready and _ready_policy_met()
+    if policy_met:
+        logger.info(f"{', '.join(READY_WHEN)} synced, sidecar is ready.")
+        mark_ready()
+
 def update_k8s_contact():
     """
     Update the timestamp of the last successful Kubernetes contact.
     """
     global last_k8s_contact
-    last_k8s_contact = datetime.now(timezone.utc)
+    last_k8s_contact = time.monotonic()
 
-def register_watcher_processes(processes: List[Thread]):
+def register_watcher_processes(processes: List[Union[Thread, "BaseProcess"]]):
     """
-    Register the list of watcher threads to be monitored for liveness.
+    Register the list of watcher threads or worker processes to be monitored for liveness.
     """
     global watcher_processes
     watcher_processes = processes
 
+def set_watchers_alive(alive: bool):
+    """
+    Report whether all registered watchers are alive. Called by the supervisor loop,
+    so probes don't have to check every watcher themselves.
+    """
+    global watchers_alive
+    watchers_alive = alive
+
+def record_skip(reason: str):
+    """
+    Count an object or key skipped by a guardrail, exposed at /healthz?verbose.
+    """
+    with _skipped_lock:
+        skipped[reason] += 1
+
+def register_watcher(name: str) -> WatcherHeartbeat:
+    """
+    Create the heartbeat slot of a watcher, exposed per watcher at /healthz?verbose.
+    """
+    heartbeat = WatcherHeartbeat(name)
+    watcher_heartbeats[name] = heartbeat
+    return heartbeat
+
 def _create_health_http_server(health_port: int) -> ThreadingHTTPServer:
     """
     Create the health HTTP server, binding to HEALTH_HOST if set.
@@ -155,7 +332,7 @@ def start_health_server():
             "filters": ["health_check_filter"],
         })
 
-        logging.config.dictConfig(log_config)
+        configure_logging(log_config)
 
         health_port = int(os.getenv("HEALTH_PORT", "8080"))
         server = _create_health_http_server(health_port)
@@ -14,12 +14,10 @@ from requests.packages.urllib3.util.retry import Retry
 from types import SimpleNamespace
 
 from logger import get_logger
-import argparse
+from script_worker import SCRIPT_WORKER, run_in_worker
 
-parser = argparse.ArgumentParser(description="CLI flags for kiwigrid sidecar")
-parser.add_argument("--req-username-file", type=str, metavar=argparse.REMAINDER, help="path to file containing basic-auth username for REQ. This takes precedence over the environment variable REQ_USERNAME")
-parser.add_argument("--req-password-file", type=str, metavar=argparse.REMAINDER, help="path to file containing basic-auth password for REQ. This takes precedence over the environment variable REQ_PASSWORD")
-args = parser.parse_args()
+# CLI flags, parsed on first use by get_cli_args() instead of at import time
+_args = None
 
 CONTENT_TYPE_TEXT          = "ascii"
 CONTENT_TYPE_BASE64_BINARY = "binary"
@@ -31,6 +29,9 @@ REQ_RETRY_BACKOFF_FACTOR = 1.1 if os.getenv("REQ_RETRY_BACKOFF_FACTOR") is None
     os.getenv("REQ_RETRY_BACKOFF_FACTOR"))
 REQ_TIMEOUT              = 10 if os.getenv("REQ_TIMEOUT") is None else float(os.getenv("REQ_TIMEOUT"))
 
+# Maximum number of characters of a response body that is logged, a negative value logs the whole body
+LOG_RESPONSE_BODY_MAX_LENGTH = int(os.getenv("LOG_RESPONSE_BODY_MAX_LENGTH", -1))
+
 # Allows to suppress TLS verification for all HTTPs requests (except to the API server, which are controller by SKIP_TLS_VERIFY)
 # This is particularly useful when the connection to the main container happens as "localhost"
 # and most likely the TLS cert offered by that will have an external URL in it.
@@ -58,6 +59,21 @@ WATCH_CLIENT_TIMEOUT = os.environ.get("WATCH_CLIENT_TIMEOUT", 66)
 logger = get_logger()
 
 
+def get_cli_args():
+    """
+    Parse the CLI flags once and return them.
+    """
+    global _args
+    if _args is None:
+        import argparse
+
+        parser = argparse.ArgumentParser(description="CLI flags for kiwigrid sidecar")
+        parser.add_argument("--req-username-file", type=str, metavar=argparse.REMAINDER, help="path to file containing basic-auth username for REQ. This takes precedence over the environment variable REQ_USERNAME")
+        parser.add_argument("--req-password-file", type=str, metavar=argparse.REMAINDER, help="path to file containing basic-auth password for REQ. This takes precedence over the environment variable REQ_PASSWORD")
+        _args = parser.parse_args()
+    return _args
+
+
 def write_data_to_file(folder, filename, data, data_type=CONTENT_TYPE_TEXT):
     """
     Write text to a file. If the parent folder doesn't exist, create it. If there are insufficient
@@ -88,7 +104,7 @@ def write_data_to_file(folder, filename, data, data_type=CONTENT_TYPE_TEXT):
                 sha256_hash_cur.update(byte_block)
 
         if sha256_hash_new.hexdigest() == sha256_hash_cur.hexdigest():
-            logger.debug(f"Contents of {filename} haven't changed. Not overwriting existing file")
+            logger.debug("Contents of %s haven't changed. Not overwriting existing file", filename)
             return False
 
     if data_type == "binary":
@@ -96,7 +112,7 @@ def write_data_to_file(folder, filename, data, data_type=CONTENT_TYPE_TEXT):
     else:
         write_type = "w"
 
-    logger.info(f"Writing {absolute_path} ({data_type})")
+    logger.info("Writing %s (%s)", absolute_path, data_type)
     with open(absolute_path, write_type) as f:
         f.write(data)
         f.close()
@@ -109,7 +125,7 @@ def write_data_to_file(folder, filename, data, data_type=CONTENT_TYPE_TEXT):
 def remove_file(folder, filename):
     complete_file = os.path.join(folder, filename)
     if os.path.isfile(complete_file):
-        logger.info(f"Removing {complete_file}")
+        logger.info("Removing %s", complete_file)
         os.remove(complete_file)
         return True
     else:
@@ -134,6 +150,7 @@ def fetch_basic_auth_credentials():
     username = os.getenv("REQ_USERNAME")
     password = os.getenv("REQ_PASSWORD")
     # CLI flags take precedence over environment variables
+    args = get_cli_args()
     req_username_file = args.req_username_file or os.getenv("REQ_USERNAME_FILE")
     req_password_file = args.req_password_file or os.getenv("REQ_PASSWORD_FILE")
     if req_username_file:
@@ -147,6 +164,12 @@ def fetch_basic_auth_credentials():
     return username, password
 
 
+def _truncate_body(text):
+    if 0 <= LOG_RESPONSE_BODY_MAX_LENGTH < len(text):
+        return f"{text[:LOG_RESPONSE_BODY_MAX_LENGTH]}... ({len(text)} characters)"
+    return text
+
+
 def request(url, method, enable_5xx=False, payload=None):
     enforce_status_codes = list() if enable_5xx else [500, 502, 503, 504]
     username,password = fetch_basic_auth_credentials()
@@ -174,10 +197,10 @@ def request(url, method, enable_5xx=False, payload=None):
         # If method is not provided use GET as default
         if method == "GET" or not method:
             res = r.get("%s" % url, auth=auth, timeout=REQ_TIMEOUT, verify=REQ_TLS_VERIFY)  # lgtm[python/request-without-cert-validation]
-            logger.info(f"Request sent to {url}. Response: {res.status_code} {res.reason} {res.text}")
+            logger.info("Request sent to %s. Response: %s %s %s", url, res.status_code, res.reason, _truncate_body(res.text))
         elif method == "POST":
             res = r.post("%s" % url, auth=auth, json=payload, timeout=REQ_TIMEOUT, verify=REQ_TLS_VERIFY)  # lgtm[python/request-without-cert-validation]
-            logger.info(f"{payload} sent to {url}. Response: {res.status_code} {res.reason} {res.text}")
+            logger.info("%s sent to %s. Response: %s %s %s", payload, url, res.status_code, res.reason, _truncate_body(res.text))
         else:
             logger.warning(f"Invalid REQ_METHOD: '{method}', please use 'GET' or 'POST'. Doing nothing.")
             return
@@ -191,7 +214,7 @@ def request(url, method, enable_5xx=False, payload=None):
     except Exception as e:
         logger.error(f"Unexpected error during request to {url}: {e}")
     # Return a dummy-object with empty attributes to avoid AttributeError if no response is returned (e.g. MaxRetryError)
-    logger.debug(f"Returning dummy response for URL {url}")
+    logger.debug("Returning dummy response for URL %s", url)
     return SimpleNamespace(text="", content=b"")
 
 def timestamp():
@@ -215,19 +238,41 @@ def unique_filename(filename, namespace, resource, resource_name):
     return "namespace_" + namespace + "." + resource + "_" + resource_name + "." + filename
 
 
-def execute(script_path):
+def execute(script_path, changes=None):
+    """
+    Run the script. If the FileChanges that triggered it are given, they are written into a file whose
+    path is passed in SIDECAR_CHANGES_FILE, together with the number of changes per kind.
+    With SCRIPT_WORKER the changes are handed to the running script instead.
+    """
+    if SCRIPT_WORKER:
+        run_in_worker(script_path, changes)
+        return
     logger.info(f"Executing script from {script_path}")
+    env = None
+    changes_file = None
+    if changes:
+        changes_file = changes.write_status_file()
+        env = dict(os.environ,
+                   SIDECAR_CHANGES_FILE=changes_file,
+                   SIDECAR_FILES_ADDED=str(len(changes.added)),
+                   SIDECAR_FILES_MODIFIED=str(len(changes.modified)),
+                   SIDECAR_FILES_REMOVED=str(len(changes.removed)))
     try:
         if os.access(script_path, os.X_OK):
             result = subprocess.run([script_path],
                                     capture_output=True,
-                                    check=True)
+                                    check=True,
+                                    env=env)
         else:
             result = subprocess.run(["sh", script_path],
                                     capture_output=True,
-                                    check=True)
-        logger.debug(f"Script stdout: {result.stdout}")
-        logger.debug(f"Script stderr: {result.stderr}")
-        logger.debug(f"Script exit code: {result.returncode}")
+                                    check=True,
+                                    env=env)
+        logger.debug("Script stdout: %s", result.stdout)
+        logger.debug("Script stderr: %s", result.stderr)
+        logger.debug("Script exit code: %s", result.returncode)
     except subprocess.CalledProcessError as e:
         logger.error(f"Script failed with error: {e}")
+    finally:
+        if changes_file is not None:
+            os.remove(changes_file)
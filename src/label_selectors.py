@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+import re
+from itertools import combinations
+
+from logger import get_logger
+
+# Separates alternative label selectors, which are OR-ed (a "," inside a selector is an AND)
+ALTERNATIVES_SEPARATOR = ";"
+
+_EQUALITY = re.compile(r"^([^\s!=]+)\s*==?\s*([^\s,()]*)$")
+_INEQUALITY = re.compile(r"^([^\s!=]+)\s*!=\s*([^\s,()]*)$")
+_SET = re.compile(r"^([^\s!=]+)\s+in\s+\(([^)]*)\)$")
+_NOT_IN_SET = re.compile(r"^([^\s!=]+)\s+notin\s+\(([^)]*)\)$")
+_EXISTS = re.compile(r"^([^\s!=(),]+)$")
+_NOT_EXISTS = re.compile(r"^!\s*([^\s!=(),]+)$")
+
+# Get logger
+logger = get_logger()
+
+
+def _split_requirements(selector):
+    """
+    Split a label selector into its requirements, keeping the commas of set-based requirements intact.
+    """
+    requirements = []
+    depth = 0
+    current = ""
+    for char in selector:
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        if char == "," and depth == 0:
+            requirements.append(current)
+            current = ""
+        else:
+            current += char
+    requirements.append(current)
+    return frozenset(_normalize(requirement) for requirement in requirements if requirement.strip())
+
+
+def _normalize(requirement):
+    requirement = " ".join(requirement.split())
+    values = _values(requirement)
+    if values is not None:
+        key, values = values
+        if len(values) == 1:
+            return f"{key}={next(iter(values))}"
+        return f"{key} in ({','.join(sorted(values))})"
+    return requirement
+
+
+def _values(requirement):
+    """
+    Return (key, set of values) for "key=value" and "key in (...)" requirements, None for any other kind.
+    """
+    match = _EQUALITY.match(requirement)
+    if match:
+        return match.group(1), {match.group(2)}
+    match = _SET.match(requirement)
+    if match:
+        return match.group(1), {value.strip() for value in match.group(2).split(",")}
+    return None
+
+
+def _implies(requirement, other):
+    """
+    Tell whether every object matching requirement also matches other, e.g. "app=a" implies "app"
+    and "app in (a,b)".
+    """
+    if requirement == other:
+        return True
+    values = _values(requirement)
+    if values is None:
+        return False
+    key, allowed = values
+    exists = _EXISTS.match(other)
+    if exists:
+        return exists.group(1) == key
+    other_values = _values(other)
+    return other_values is not None and other_values[0] == key and allowed <= other_values[1]
+
+
+def _covers(broad, narrow):
+    """
+    Tell whether the selector broad matches every object the selector narrow matches.
+    """
+    return all(any(_implies(requirement, other) for requirement in narrow) for other in broad)
+
+
+def _merge(a, b):
+    """
+    Merge two selectors into one if they only differ in the values allowed for a single key.
+    """
+    only_a, only_b = a - b, b - a
+    if len(only_a) != 1 or len(only_b) != 1:
+        return None
+    values_a, values_b = _values(next(iter(only_a))), _values(next(iter(only_b)))
+    if values_a is None or values_b is None or values_a[0] != values_b[0]:
+        return None
+    key = values_a[0]
+    return (a & b) | {f"{key} in ({','.join(sorted(values_a[1] | values_b[1]))})"}
+
+
+def merge_label_selectors(selectors):
+    """
+    Reduce alternative (OR-ed) label selectors to the fewest selectors matching the same objects, so
+    every object is watched by as few server-side filtered watches as possible. Selectors which are
+    more restrictive than another one are dropped, e.g. "app=a" next to "app" or "app in (a,b)", and selectors differing only in the value of one
+    key are merged into a set-based requirement, e.g. "app=a" and "app=b" become "app in (a,b)".
+    """
+    terms = {_split_requirements(selector) for selector in selectors}
+    changed = True
+    while changed:
+        changed = False
+        for a, b in combinations(sorted(terms, key=sorted), 2):
+            if _covers(a, b) or _covers(b, a):
+                terms.discard(b if _covers(a, b) else a)
+                changed = True
+                break
+            merged = _merge(a, b)
+            if merged is not None:
+                terms -= {a, b}
+                terms.add(merged)
+                changed = True
+                break
+    merged_selectors = sorted(",".join(sorted(term)) for term in terms)
+    if len(merged_selectors) < len(selectors):
+        logger.info(f"Merged {len(selectors)} label selectors into {len(merged_selectors)}: {merged_selectors}")
+    return merged_selectors
+
+
+def get_label_selectors(label, label_value, label_selector):
+    """
+    Return the label selectors to watch, built from LABEL/LABEL_VALUE and the alternatives of LABEL_SELECTOR.
+    """
+    selectors = []
+    if label:
+        selectors.append(f"{label}={label_value}" if label_value else label)
+    if label_selector:
+        selectors += [selector.strip() for selector in label_selector.split(ALTERNATIVES_SEPARATOR)
+                      if selector.strip()]
+    return merge_label_selectors(selectors)
+
+
+def _compile_requirement(requirement):
+    values = _values(requirement)
+    if values is not None:
+        key, allowed = values
+        return lambda labels: labels.get(key) in allowed
+    match = _INEQUALITY.match(requirement) or _NOT_IN_SET.match(requirement)
+    if match:
+        key = match.group(1)
+        excluded = {value.strip() for value in match.group(2).split(",")}
+        return lambda labels: labels.get(key) not in excluded
+    match = _EXISTS.match(requirement)
+    if match:
+        key = match.group(1)
+        return lambda labels: key in labels
+    match = _NOT_EXISTS.match(requirement)
+    if match:
+        key = match.group(1)
+        return lambda labels: key not in labels
+    raise ValueError(f"Unsupported label selector requirement: {requirement}")
+
+
+def compile_label_selector(selector):
+    """
+    Compile a label selector into a function telling whether a dict of labels matches it,
+    to evaluate selectors client-side the same way the API server does.
+    """
+    requirements = [_compile_requirement(requirement) for requirement in _split_requirements(selector)]
+    return lambda labels: all(requirement(labels) for requirement in requirements)
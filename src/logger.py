@@ -1,19 +1,20 @@
+import atexit
 import logging
 import os
+import queue
 import sys
-import yaml
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 from typing import Optional
 
-from dateutil.tz import tzlocal, tzutc
-from logfmter import Logfmter
-from pythonjsonlogger import jsonlogger
 from logging import config
 
-# Supported Timezones for time format (in ISO 8601)
+# Supported Timezones for time format (in ISO 8601). None renders in the local timezone.
 LogTimezones = {
-    'LOCAL': tzlocal(),
-    'UTC': tzutc()
+    'LOCAL': None,
+    'UTC': timezone.utc
 }
 
 # Get configuration
@@ -21,8 +22,11 @@ level = os.getenv("LOG_LEVEL", logging.INFO)
 fmt = os.getenv("LOG_FORMAT", 'JSON')
 tz = os.getenv("LOG_TZ", 'LOCAL')
 log_conf_file = os.getenv("LOG_CONFIG","")
+log_async = os.getenv("LOG_ASYNC", "false").lower() == "true"
+log_rate_limit_burst = int(os.getenv("LOG_RATE_LIMIT_BURST", 0))
+log_rate_limit_interval = float(os.getenv("LOG_RATE_LIMIT_INTERVAL", 60))
 
-log_tz = LogTimezones[tz.upper()] if LogTimezones.get(tz.upper()) else LogTimezones['LOCAL']
+log_tz = LogTimezones.get(tz.upper(), LogTimezones['LOCAL'])
 
 
 class Iso8601Formatter:
@@ -35,24 +39,54 @@ class Iso8601Formatter:
         """
         Meant to override logging.Formatter.formatTime
         """
+        if log_tz is None:
+            return datetime.fromtimestamp(record.created).astimezone().isoformat()
         return datetime.fromtimestamp(record.created, log_tz).isoformat()
 
 
-class LogfmtFormatter(Iso8601Formatter, Logfmter):
-    """
-    A formatter combining logfmt style with iso dates
-    """
-    pass
+def _build_logfmt_formatter():
+    from logfmter import Logfmter
+
+    class LogfmtFormatter(Iso8601Formatter, Logfmter):
+        """
+        A formatter combining logfmt style with iso dates
+        """
+        pass
+
+    return LogfmtFormatter
+
 
+def _build_json_formatter():
+    from pythonjsonlogger import jsonlogger
 
-class JsonFormatter(Iso8601Formatter, jsonlogger.JsonFormatter):
+    class JsonFormatter(Iso8601Formatter, jsonlogger.JsonFormatter):
+        """
+        A formatter combining json logs with iso dates
+        """
+
+        def add_fields(self, log_record, record, message_dict):
+            log_record['time'] = self.formatTime(record)
+            super(JsonFormatter, self).add_fields(log_record, record, message_dict)
+
+    return JsonFormatter
+
+
+_formatter_builders = {
+    'LogfmtFormatter': _build_logfmt_formatter,
+    'JsonFormatter': _build_json_formatter,
+}
+
+
+def __getattr__(name):
     """
-    A formatter combining json logs with iso dates
+    Build the formatter classes on first access (e.g. by dictConfig resolving "logger.JsonFormatter"),
+    so only the library of the log format in use is imported.
     """
-
-    def add_fields(self, log_record, record, message_dict):
-        log_record['time'] = self.formatTime(record)
-        super(JsonFormatter, self).add_fields(log_record, record, message_dict)
+    if name in _formatter_builders:
+        formatter_class = _formatter_builders[name]()
+        globals()[name] = formatter_class
+        return formatter_class
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class RemoveColorMessageFilter(logging.Filter):
@@ -66,16 +100,123 @@ class RemoveColorMessageFilter(logging.Filter):
         return True
 
 
+class RateLimitFilter(logging.Filter):
+    """
+    A logging filter that lets at most `burst` records per `interval` seconds through for every
+    logging call site. Records of level ERROR and above are never dropped. The number of dropped
+    records is attached as `suppressed` to the next record let through for that call site.
+    """
+    def __init__(self, burst=10, interval=60.0):
+        super().__init__()
+        self.burst = int(burst)
+        self.interval = float(interval)
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.burst <= 0 or record.levelno >= logging.ERROR:
+            return True
+        key = (record.name, record.levelno, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            window_start, count, suppressed = self._windows.get(key, (now, 0, 0))
+            if now - window_start >= self.interval:
+                window_start, count = now, 0
+            if count >= self.burst:
+                self._windows[key] = (window_start, count, suppressed + 1)
+                return False
+            self._windows[key] = (window_start, count + 1, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class _AsyncQueueHandler(QueueHandler):
+    """
+    A queue handler which only merges the message arguments in the logging thread and leaves the
+    formatting, including exception info, to the handlers run by the listener thread.
+    """
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+_queue_listener = None
+
+
+def _stop_async_logging():
+    global _queue_listener
+    if _queue_listener is not None:
+        _queue_listener.stop()
+        _queue_listener = None
+
+
+def _start_async_logging():
+    """
+    Move the configured root handlers behind a queue, so logging calls never block on a slow stdout.
+    """
+    global _queue_listener
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    if not handlers:
+        return
+    log_queue = queue.SimpleQueue()
+    _queue_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(_AsyncQueueHandler(log_queue))
+    _queue_listener.start()
+
+
+def _restart_async_logging_after_fork():
+    """
+    Forked processes, e.g. watcher worker processes, inherit the queue handler but not the listener thread.
+    Give them a queue and listener of their own, so their records are written instead of piling up.
+    """
+    global _queue_listener
+    if _queue_listener is None:
+        return
+    log_queue = queue.SimpleQueue()
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, _AsyncQueueHandler):
+            handler.queue = log_queue
+    _queue_listener = QueueListener(log_queue, *_queue_listener.handlers, respect_handler_level=True)
+    _queue_listener.start()
+
+
+# Flush queued records on exit
+atexit.register(_stop_async_logging)
+os.register_at_fork(after_in_child=_restart_async_logging_after_fork)
+
+
 # Supported Log Formatters
 LogFormatters = {
-    'JSON': (JsonFormatter('%(levelname)s %(message)s',
-                           rename_fields={"message": "msg", "levelname": "level"})),
-    'LOGFMT': (LogfmtFormatter(keys=["time", "level", "msg"],
-                               mapping={"time": "asctime", "level": "levelname", "msg": "message"}))
+    'JSON': {
+        "()": "logger.JsonFormatter",
+        "format": "%(levelname)s %(message)s",
+        "rename_fields": {
+            "message": "msg",
+            "levelname": "level"
+        }
+    },
+    'LOGFMT': {
+        "()": "logger.LogfmtFormatter",
+        "keys": [
+            "time",
+            "level",
+            "msg"
+        ],
+        "mapping": {
+            "time": "asctime",
+            "level": "levelname",
+            "msg": "message"
+        }
+    }
 }
 
 logLevel = level.upper() if isinstance(level, str) else level
-log_fmt = LogFormatters[fmt.upper()] if LogFormatters.get(fmt.upper()) else LogFormatters['JSON']
+log_fmt = fmt.upper() if fmt.upper() in LogFormatters else 'JSON'
 
 default_log_config = {
     "version": 1,
@@ -89,43 +230,30 @@ default_log_config = {
     "filters": {
         "remove_color_message": {
             "()": "logger.RemoveColorMessageFilter"
+        },
+        "rate_limit": {
+            "()": "logger.RateLimitFilter",
+            "burst": log_rate_limit_burst,
+            "interval": log_rate_limit_interval
         }
     },
     "handlers": {
         "console": {
             "class": "logging.StreamHandler",
             "level": logLevel,
-            "formatter": fmt.upper(),
-            "filters": ["remove_color_message"]
+            "formatter": log_fmt,
+            "filters": ["remove_color_message", "rate_limit"]
         }
     },
+    # Only the selected formatter is configured, so the other one's library is never imported
     "formatters": {
-        "JSON": {
-            "()": "logger.JsonFormatter",
-            "format": "%(levelname)s %(message)s",
-            "rename_fields": {
-                "message": "msg",
-                "levelname": "level"
-            }
-        },
-        "LOGFMT": {
-            "()": "logger.LogfmtFormatter",
-            "keys": [
-                "time",
-                "level",
-                "msg"
-            ],
-            "mapping": {
-                "time": "asctime",
-                "level": "levelname",
-                "msg": "message"
-            }
-        }
+        log_fmt: LogFormatters[log_fmt]
     }
 }
 
 def get_log_config():
     if log_conf_file != "" :
+        import yaml
         try:
             with open(log_conf_file, 'r') as stream:
                 config = yaml.load(stream, Loader=yaml.FullLoader)
@@ -141,9 +269,19 @@ def get_log_config():
     else:
         return default_log_config    
 
+def configure_logging(log_config):
+    """
+    Apply a logging configuration, putting the root handlers behind a queue if LOG_ASYNC is enabled.
+    """
+    _stop_async_logging()
+    config.dictConfig(log_config)
+    if log_async:
+        _start_async_logging()
+
+
 # Initialize/configure root logger
 log_config = get_log_config()    
-config.dictConfig(log_config)
+configure_logging(log_config)
 
 def get_logger():
     return logging.getLogger('k8s-sidecar')
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+import glob
+import json
+import os
+import tempfile
+from collections import defaultdict
+from threading import Lock, RLock
+
+from logger import get_logger
+
+# Path of the on-disk manifest. If unset the index is only kept in memory.
+MANIFEST_FILE = os.getenv("MANIFEST_FILE")
+
+MANIFEST_VERSION = 1
+
+# Index of every file the sidecar owns, keyed by object:
+# {resource: {namespace: {name: set(absolute paths)}}}
+_manifest = defaultdict(lambda: defaultdict(dict))
+_manifest_lock = RLock()
+# Held from taking a snapshot until it replaced the file, so an older snapshot never replaces a newer one
+_save_lock = Lock()
+_manifest_dirty = False
+# Manifests of worker processes merged on load, removed once the merged manifest is saved
+_merged_worker_files = []
+
+# Get logger
+logger = get_logger()
+
+
+def track_object(resource, namespace, name):
+    """
+    Make sure the object is present in the index, even if it owns no files yet.
+    """
+    global _manifest_dirty
+    with _manifest_lock:
+        if name not in _manifest[resource][namespace]:
+            _manifest[resource][namespace][name] = set()
+            _manifest_dirty = True
+
+
+def record_file(resource, namespace, name, path):
+    """
+    Record that the object owns the file at path.
+    """
+    global _manifest_dirty
+    path = os.path.abspath(path)
+    with _manifest_lock:
+        files = _manifest[resource][namespace].setdefault(name, set())
+        if path not in files:
+            files.add(path)
+            _manifest_dirty = True
+
+
+def forget_file(resource, namespace, name, path):
+    """
+    Drop the file at path from the files owned by the object.
+    """
+    global _manifest_dirty
+    path = os.path.abspath(path)
+    with _manifest_lock:
+        files = _manifest[resource][namespace].get(name)
+        if files is not None and path in files:
+            files.discard(path)
+            _manifest_dirty = True
+
+
+def is_recorded(resource, namespace, name, path):
+    """
+    Check whether the object already owns the file at path.
+    """
+    with _manifest_lock:
+        files = _manifest.get(resource, {}).get(namespace, {}).get(name)
+        return files is not None and os.path.abspath(path) in files
+
+
+def forget_object(resource, namespace, name, folder=None):
+    """
+    Drop the object from the index and return the files it owned. If folder is given, only the files
+    in that folder are dropped and the object keeps its other files.
+    """
+    global _manifest_dirty
+    with _manifest_lock:
+        files = _manifest[resource][namespace].get(name)
+        if files is None:
+            return set()
+        if folder is not None:
+            folder = os.path.abspath(folder)
+            forgotten = {path for path in files if os.path.dirname(path) == folder}
+            files -= forgotten
+        else:
+            forgotten = files
+            files = None
+        if not files:
+            _manifest[resource][namespace].pop(name)
+            if not _manifest[resource][namespace]:
+                _manifest[resource].pop(namespace)
+        _manifest_dirty = True
+        return forgotten
+
+
+def set_worker_index(index):
+    """
+    Make a forked worker process persist its index into its own manifest file,
+    so workers never overwrite each other's updates.
+    """
+    global MANIFEST_FILE
+    if MANIFEST_FILE:
+        MANIFEST_FILE = f"{MANIFEST_FILE}.worker-{index}"
+
+
+def _read_manifest_file(path):
+    try:
+        with open(path, "r") as f:
+            content = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"Unable to read manifest {path}, ignoring it: {e}")
+        return None
+
+    if content.get("version") != MANIFEST_VERSION:
+        logger.warning(f"Unsupported manifest version {content.get('version')} in {path}, ignoring it")
+        return None
+    return content
+
+
+def load_manifest():
+    """
+    Load the on-disk manifest, merged with the manifests of worker processes, into the index.
+    Returns False if there was nothing to load.
+    """
+    global _manifest_dirty, _merged_worker_files
+    if not MANIFEST_FILE:
+        return False
+    worker_files = sorted(glob.glob(glob.escape(MANIFEST_FILE) + ".worker-*"))
+    paths = ([MANIFEST_FILE] if os.path.isfile(MANIFEST_FILE) else []) + worker_files
+    contents = [content for content in map(_read_manifest_file, paths) if content is not None]
+    if not contents:
+        return False
+
+    with _manifest_lock:
+        for content in contents:
+            for resource, namespaces in content.get("objects", {}).items():
+                for namespace, objects in namespaces.items():
+                    for name, files in objects.items():
+                        _manifest[resource][namespace].setdefault(name, set()).update(files)
+        _manifest_dirty = bool(worker_files)
+        _merged_worker_files = worker_files
+    logger.info(f"Loaded manifest from {', '.join(paths)}")
+    return True
+
+
+def save_manifest():
+    """
+    Persist the index if it changed since the last save. The file is replaced atomically
+    so a crash never leaves a truncated manifest behind.
+    """
+    global _manifest_dirty, _merged_worker_files
+    if not MANIFEST_FILE:
+        return
+    with _save_lock:
+        with _manifest_lock:
+            if not _manifest_dirty:
+                return
+            content = {
+                "version": MANIFEST_VERSION,
+                "objects": {
+                    resource: {
+                        namespace: {name: sorted(files) for name, files in objects.items()}
+                        for namespace, objects in namespaces.items() if objects
+                    }
+                    for resource, namespaces in _manifest.items()
+                }
+            }
+            _manifest_dirty = False
+
+        folder = os.path.dirname(os.path.abspath(MANIFEST_FILE))
+        try:
+            os.makedirs(folder, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".manifest-")
+            with os.fdopen(fd, "w") as f:
+                json.dump(content, f)
+            os.replace(tmp_path, MANIFEST_FILE)
+        except OSError as e:
+            logger.error(f"Unable to write manifest {MANIFEST_FILE}: {e}")
+            with _manifest_lock:
+                _manifest_dirty = True
+            return
+
+        for path in _merged_worker_files:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        _merged_worker_files = []
+
+
+def forget_orphans(live_objects):
+    """
+    Drop every object that is not in live_objects, a set of (resource, namespace, name) tuples, from the
+    index. Returns the files they owned which no live object owns, each mapped to the (resource, namespace,
+    name) of the object that owned it. Removing the files is up to the caller, which knows the output sink.
+    """
+    with _manifest_lock:
+        orphans = [(resource, namespace, name)
+                   for resource, namespaces in _manifest.items()
+                   for namespace, objects in namespaces.items()
+                   for name in objects
+                   if (resource, namespace, name) not in live_objects]
+        if not orphans:
+            return {}
+        orphan_files = {}
+        for resource, namespace, name in orphans:
+            for path in forget_object(resource, namespace, name):
+                orphan_files[path] = (resource, namespace, name)
+        live_files = {path
+                      for namespaces in _manifest.values()
+                      for objects in namespaces.values()
+                      for files in objects.values()
+                      for path in files}
+    logger.info(f"Removed {len(orphans)} orphaned objects from the manifest")
+    return {path: owner for path, owner in orphan_files.items() if path not in live_files}
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+import json
+
+from changes import PayloadTemplate
+from label_selectors import compile_label_selector, get_label_selectors
+from logger import get_logger
+from resources import prepare_payload
+
+# Get logger
+logger = get_logger()
+
+
+class Pipeline:
+    """
+    A label selector routed to its own target folder, script and request. All pipelines of a sidecar
+    share the watches of the resources and namespaces they have in common.
+    """
+
+    def __init__(self, name, label_selectors, target_folder, folder_annotation, resources, script=None,
+                 request_url=None, request_method=None, request_payload=None, unique_filenames=False,
+                 enable_5xx=False):
+        self.name = name
+        self.label_selectors = label_selectors
+        self.target_folder = target_folder
+        self.folder_annotation = folder_annotation
+        self.resources = resources
+        self.script = script
+        self.request_url = request_url
+        self.request_method = request_method
+        self.request_payload = request_payload
+        self.unique_filenames = unique_filenames
+        self.enable_5xx = enable_5xx
+        self._matchers = [compile_label_selector(selector) for selector in label_selectors]
+
+    def matches(self, resource, labels):
+        return resource in self.resources and any(matcher(labels or {}) for matcher in self._matchers)
+
+    def __repr__(self):
+        return f"Pipeline({self.name})"
+
+
+def _parse_pipeline(index, config, defaults):
+    name = str(config.get("name", index))
+    label_selectors = get_label_selectors(config.get("label"), config.get("labelValue"), config.get("labelSelector"))
+    if not label_selectors:
+        raise ValueError(f"Pipeline {name} needs a label or labelSelector")
+    target_folder = config.get("folder")
+    if not target_folder:
+        raise ValueError(f"Pipeline {name} needs a folder")
+    resources = config.get("resource", defaults["resource"])
+    resources = ("secret", "configmap") if resources == "both" else (resources,)
+    request_payload = config.get("reqPayload")
+    if isinstance(request_payload, str):
+        request_payload = prepare_payload(request_payload)
+    if config.get("reqPayloadTemplate") is not None:
+        template = config["reqPayloadTemplate"]
+        request_payload = PayloadTemplate(prepare_payload(template) if isinstance(template, str) else template)
+    return Pipeline(name, label_selectors, target_folder,
+                    config.get("folderAnnotation", defaults["folder_annotation"]),
+                    resources,
+                    config.get("script"),
+                    config.get("reqUrl"),
+                    config.get("reqMethod"),
+                    request_payload,
+                    str(config.get("uniqueFilenames", defaults["unique_filenames"])).lower() == "true",
+                    str(config.get("enable5xx", defaults["enable_5xx"])).lower() == "true")
+
+
+def load_pipelines(path, resource, folder_annotation, unique_filenames, enable_5xx):
+    """
+    Read the pipelines from a config file of the form
+
+        pipelines:
+          - name: dashboards
+            labelSelector: grafana_dashboard=1
+            folder: /tmp/dashboards
+            reqUrl: http://localhost:3000/api/admin/provisioning/dashboards/reload
+
+    Settings missing from a pipeline default to the values of the corresponding environment variables.
+    """
+    with open(path) as f:
+        if path.endswith(".json"):
+            config = json.load(f)
+        else:
+            import yaml
+            config = yaml.safe_load(f)
+
+    defaults = {"resource": resource, "folder_annotation": folder_annotation,
+                "unique_filenames": unique_filenames, "enable_5xx": enable_5xx}
+    pipelines = [_parse_pipeline(index, pipeline, defaults)
+                 for index, pipeline in enumerate((config or {}).get("pipelines") or ())]
+    names = [pipeline.name for pipeline in pipelines]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Pipeline names must be unique: {names}")
+    for pipeline in pipelines:
+        logger.info(f"Pipeline {pipeline.name}: {pipeline.label_selectors} on {pipeline.resources} "
+                    f"into {pipeline.target_folder}")
+    return pipelines
+
+
+def pipeline_resources(pipelines):
+    return tuple(sorted({resource for pipeline in pipelines for resource in pipeline.resources}))
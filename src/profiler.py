@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+import atexit
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from logger import get_logger
+
+# Settings
+PROFILE_DURATION = float(os.getenv("PROFILE_DURATION", 60))  # seconds to record
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.01))  # seconds between samples
+PROFILE_OUTPUT = os.getenv("PROFILE_OUTPUT", "/tmp/k8s-sidecar-profile.txt")
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", 30))  # entries per section of the report
+PROFILE_TRACEMALLOC = os.getenv("PROFILE_TRACEMALLOC", "true").lower() == "true"
+
+# Innermost functions of threads that are blocked waiting, such samples are counted as idle
+IDLE_FUNCTIONS = {"select", "poll", "wait", "accept", "readinto", "recv_into", "_wait_for_tstate_lock"}
+
+# Latest report, served at /debug/profile by the health server
+_report = None
+_profiler = None
+
+# Get logger
+logger = get_logger()
+
+
+class SamplingProfiler:
+    """
+    A sampling profiler covering every thread of the process. Each sample walks the current stack of all
+    threads, counting the innermost function as "self" and every function on the stack as "cumulative".
+    Samples are wall clock based, threads blocked in one of IDLE_FUNCTIONS are only counted as idle.
+    """
+
+    def __init__(self, duration, interval, stats_fn=None):
+        self.duration = duration
+        self.interval = interval
+        self.stats_fn = stats_fn
+        self.self_counts = Counter()
+        self.cumulative_counts = Counter()
+        self.samples = 0
+        self.idle_samples = 0
+        self.threads = set()
+        self._stop = threading.Event()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._started = None
+        self._snapshot = None
+
+    def start(self):
+        if PROFILE_TRACEMALLOC:
+            tracemalloc.start()
+            self._snapshot = tracemalloc.take_snapshot()
+        self._started = time.monotonic()
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling early and wait for the report to be written.
+        """
+        self._stop.set()
+        self._done.wait(timeout=10)
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        deadline = self._started + self.duration
+        try:
+            while not self._stop.is_set() and time.monotonic() < deadline:
+                self._sample(own_ident)
+                self._stop.wait(self.interval)
+            _set_report(self.report())
+        except Exception:
+            logger.exception("Profiler failed")
+        finally:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            self._done.set()
+
+    def _sample(self, own_ident):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_ident:
+                continue
+            self.threads.add(thread_id)
+            if frame.f_code.co_name in IDLE_FUNCTIONS:
+                self.idle_samples += 1
+                continue
+            seen = set()
+            leaf = True
+            while frame is not None:
+                code = frame.f_code
+                key = (code.co_name, code.co_filename, code.co_firstlineno)
+                if leaf:
+                    self.self_counts[key] += 1
+                    leaf = False
+                if key not in seen:
+                    self.cumulative_counts[key] += 1
+                    seen.add(key)
+                frame = frame.f_back
+        self.samples += 1
+
+    def report(self):
+        elapsed = time.monotonic() - self._started
+        lines = [f"k8s-sidecar profile: {elapsed:.1f}s recorded, {self.samples} samples "
+                 f"every {self.interval * 1000:.0f}ms across {len(self.threads)} threads (wall clock), "
+                 f"{self.idle_samples} samples of waiting threads excluded"]
+
+        for title, counts in (("self", self.self_counts), ("cumulative", self.cumulative_counts)):
+            lines += ["", f"Top {PROFILE_TOP} functions by {title} samples:",
+                      f"{'samples':>8} {'seconds':>8}  function"]
+            for (name, filename, lineno), count in counts.most_common(PROFILE_TOP):
+                lines.append(f"{count:>8} {count * self.interval:>8.2f}  {name} ({filename}:{lineno})")
+
+        if self.stats_fn is not None:
+            lines += ["", "Cache:"]
+            lines += [f"  {name}: {value}" for name, value in self.stats_fn().items()]
+
+        if self._snapshot is not None and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            lines += ["", f"Traced memory: {current / 1024:.0f} KiB current, {peak / 1024:.0f} KiB peak",
+                      f"Top {PROFILE_TOP} allocation sites by growth since profiling started:"]
+            for stat in snapshot.compare_to(self._snapshot, "lineno")[:PROFILE_TOP]:
+                lines.append(f"  {stat}")
+        return "\n".join(lines) + "\n"
+
+
+def _set_report(report):
+    global _report
+    _report = report
+    try:
+        with open(PROFILE_OUTPUT, "w") as f:
+            f.write(report)
+        logger.info(f"Profile written to {PROFILE_OUTPUT}")
+    except OSError as e:
+        logger.error(f"Unable to write profile to {PROFILE_OUTPUT}: {e}")
+
+
+def get_report():
+    """
+    Return the latest profile report, or None if no profile has been recorded yet.
+    """
+    return _report
+
+
+def is_profiling():
+    return _profiler is not None and not _profiler._done.is_set()
+
+
+def start_profiler(stats_fn=None):
+    """
+    Record a profile of the whole process for PROFILE_DURATION seconds. stats_fn may return a dict
+    of additional statistics (e.g. cache sizes) to include in the report.
+    """
+    global _profiler
+    _profiler = SamplingProfiler(PROFILE_DURATION, PROFILE_INTERVAL, stats_fn)
+    logger.info(f"Profiling for {PROFILE_DURATION:.0f}s, the report will be written to {PROFILE_OUTPUT}")
+    _profiler.start()
+    # Write the report of short runs (e.g. METHOD=LIST) on exit
+    atexit.register(_profiler.stop)
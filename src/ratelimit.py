@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+import functools
+import os
+import random
+from collections import OrderedDict, deque
+from threading import Condition
+from time import monotonic
+
+from logger import get_logger
+
+# Requests per second to the Kubernetes API, shared by all watchers of a process. 0 disables the limit.
+API_QPS = float(os.getenv("API_QPS", 0))
+# Requests that may be sent at once after a quiet period
+API_BURST = int(os.getenv("API_BURST", 10))
+
+# Get logger
+logger = get_logger()
+
+
+class FairTokenBucket:
+    """
+    A token bucket refilled with qps tokens per second, holding at most burst tokens. Callers waiting for a
+    token are queued per key and the keys take turns, so a key sending many requests cannot starve the others.
+    """
+
+    def __init__(self, qps, burst):
+        self.qps = qps
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._last_refill = monotonic()
+        self._queues = OrderedDict()  # key -> deque of waiting tickets, in the order the keys take turns
+        self._condition = Condition()
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.qps)
+        self._last_refill = now
+
+    def _next_ticket(self):
+        return self._queues[next(iter(self._queues))][0]
+
+    def acquire(self, key):
+        """
+        Block until a token is available and it is the turn of key. Returns the seconds waited.
+        """
+        ticket = object()
+        started = monotonic()
+        with self._condition:
+            self._queues.setdefault(key, deque()).append(ticket)
+            while True:
+                self._refill()
+                if self._next_ticket() is ticket:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        queue = self._queues.pop(key)
+                        queue.popleft()
+                        if queue:
+                            # Back to the end of the line for the next request of this key
+                            self._queues[key] = queue
+                        self._condition.notify_all()
+                        return monotonic() - started
+                    self._condition.wait((1 - self._tokens) / self.qps)
+                else:
+                    self._condition.wait()
+
+
+_bucket = None
+
+
+def _get_bucket():
+    global _bucket
+    if _bucket is None:
+        _bucket = FairTokenBucket(API_QPS, API_BURST)
+    return _bucket
+
+
+class RateLimitedApi:
+    """
+    Proxy of a kubernetes API object taking a token of the shared bucket before every call, keyed by the
+    namespace of the call. Methods keep their docstrings, which watch.Watch().stream() inspects.
+    """
+
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        attribute = getattr(self._api, name)
+        if not callable(attribute) or name.startswith("_"):
+            return attribute
+
+        @functools.wraps(attribute)
+        def call(*args, **kwargs):
+            waited = _get_bucket().acquire(kwargs.get("namespace", ""))
+            if waited > 1:
+                logger.debug(f"Waited {waited:.1f}s for the API rate limit before {name}")
+            return attribute(*args, **kwargs)
+
+        return call
+
+
+def rate_limited(api):
+    """
+    Return the API object limited to API_QPS, or unchanged if no limit is configured.
+    """
+    if API_QPS <= 0:
+        return api
+    return RateLimitedApi(api)
+
+
+def jittered(seconds):
+    """
+    Spread a retry delay over 50% to 150% of its value, so watchers failing together don't retry together.
+    """
+    return seconds * random.uniform(0.5, 1.5)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+class ObjectMeta:
+    """
+    The subset of V1ObjectMeta the sidecar uses, built straight from the JSON of the API server.
+    """
+    __slots__ = ("name", "namespace", "resource_version", "annotations", "labels")
+
+    def __init__(self, name=None, namespace=None, resource_version=None, annotations=None, labels=None):
+        self.name = name
+        self.namespace = namespace
+        self.resource_version = resource_version
+        self.annotations = annotations
+        self.labels = labels
+
+    @classmethod
+    def from_dict(cls, metadata):
+        return cls(metadata.get("name"),
+                   metadata.get("namespace"),
+                   metadata.get("resourceVersion"),
+                   metadata.get("annotations"),
+                   metadata.get("labels"))
+
+    def __deepcopy__(self, memo):
+        return ObjectMeta(self.name,
+                          self.namespace,
+                          self.resource_version,
+                          dict(self.annotations) if self.annotations is not None else None,
+                          dict(self.labels) if self.labels is not None else None)
+
+
+class ResourceRecord:
+    """
+    Lightweight stand-in for V1ConfigMap and V1Secret, exposing the same attribute names
+    so it can be fed to the same processing pipeline without going through the
+    reflective model deserialization of the kubernetes client.
+    """
+    __slots__ = ("metadata", "data", "binary_data", "type")
+
+    def __init__(self, metadata, data=None, binary_data=None, type=None):
+        self.metadata = metadata
+        self.data = data
+        self.binary_data = binary_data
+        self.type = type
+
+    @classmethod
+    def from_dict(cls, obj):
+        return cls(ObjectMeta.from_dict(obj.get("metadata") or {}),
+                   obj.get("data"),
+                   obj.get("binaryData"),
+                   obj.get("type"))
+
+    def __deepcopy__(self, memo):
+        # Values are immutable strings, copying the dicts is enough
+        return ResourceRecord(self.metadata.__deepcopy__(memo),
+                              dict(self.data) if self.data is not None else None,
+                              dict(self.binary_data) if self.binary_data is not None else None,
+                              self.type)
@@ -2,25 +2,38 @@
 
 import base64
 import copy
+import fnmatch
 import os
 import signal
 import sys
 import traceback
 import json
+import re
 from collections import defaultdict
-from threading import Thread, Event
+from functools import lru_cache
+from threading import Thread, Event, Lock
 from time import sleep
 
 from kubernetes import client, watch
 from kubernetes.client.rest import ApiException
+from kubernetes.watch.watch import iter_resp_lines
 from urllib3.exceptions import MaxRetryError, ProtocolError
 
 from helpers import (CONTENT_TYPE_BASE64_BINARY, CONTENT_TYPE_TEXT,
                      WATCH_CLIENT_TIMEOUT, WATCH_SERVER_TIMEOUT, execute,
-                     remove_file, request, unique_filename, write_data_to_file)
+                     request, unique_filename)
 from logger import get_logger
-from client import _initialize_kubeclient_configuration, get_api_client
-from healthz import mark_ready, register_watcher_processes, update_k8s_contact
+from client import _initialize_kubeclient_configuration, get_api_client, uses_daemon
+from changes import ADDED, MODIFIED, REMOVED, FileChanges, render_payload
+from drift import file_lock, is_repairing, stop_drift_repair, track_file, untrack_file
+from label_selectors import merge_label_selectors
+from ratelimit import jittered, rate_limited
+from records import ResourceRecord
+from sinks import get_sink, supports_worker_processes
+from healthz import (mark_ready, record_skip, register_watcher, register_watcher_processes, set_watchers_alive,
+                     update_k8s_contact)
+from manifest import (forget_file, forget_object, forget_orphans, is_recorded, record_file, save_manifest,
+                      set_worker_index, track_object)
 
 RESOURCE_SECRET = "secret"
 RESOURCE_CONFIGMAP = "configmap"
@@ -38,6 +51,10 @@ _read_namespace = {
     RESOURCE_CONFIGMAP: "read_namespaced_config_map"
 }
 
+# State maps are sharded by the scope a watcher is responsible for, its namespace and label selector:
+# {resource: {watched scope: {namespace + name: value}}}
+# Each shard is only read and written by the thread watching that scope,
+# so reconciliation never has to copy or lock the state of other watchers.
 _resources_version_map = {
     RESOURCE_SECRET: {},
     RESOURCE_CONFIGMAP: {},
@@ -50,6 +67,47 @@ _resources_dest_folder_map = {
     RESOURCE_SECRET: {},
     RESOURCE_CONFIGMAP: {},
 }
+_shards_lock = Lock()
+
+# Resource version to LIST with: unset for a consistent read from etcd, "0" for any version the
+# apiserver's watch cache holds, or "NotOlderThan" for a cached version at least as recent as the previous LIST
+LIST_RESOURCE_VERSION = os.getenv("LIST_RESOURCE_VERSION", "")
+# Stream LISTs as a WatchList, a watch that sends the current objects and marks their end with a bookmark.
+# Watchers then resume from that bookmark instead of replaying every object.
+WATCH_LIST = os.getenv("WATCH_LIST", "false").lower() == "true"
+INITIAL_EVENTS_END_ANNOTATION = "k8s.io/initial-events-end"
+# Collection resource version of the last LIST of every scope: {resource: {scope: resource version}}
+_list_resource_versions = {
+    RESOURCE_SECRET: {},
+    RESOURCE_CONFIGMAP: {},
+}
+
+# Decode list and watch responses straight from JSON into ResourceRecords instead of kubernetes model objects
+RAW_JSON_DECODING = os.getenv("RAW_JSON_DECODING", "false").lower() == "true"
+
+# Field selectors applied to the list and watch requests of all resources, and of a single resource
+FIELD_SELECTOR = os.getenv("FIELD_SELECTOR")
+_resource_field_selectors = {
+    RESOURCE_SECRET: os.getenv("SECRET_FIELD_SELECTOR"),
+    RESOURCE_CONFIGMAP: os.getenv("CONFIGMAP_FIELD_SELECTOR"),
+}
+
+# Data keys to write and to skip, comma separated globs or regular expressions prefixed with "re:"
+KEY_INCLUDE = os.getenv("KEY_INCLUDE")
+KEY_EXCLUDE = os.getenv("KEY_EXCLUDE")
+# Annotations overriding KEY_INCLUDE and KEY_EXCLUDE for a single object
+KEY_INCLUDE_ANNOTATION = os.getenv("KEY_INCLUDE_ANNOTATION", "k8s-sidecar-key-include")
+KEY_EXCLUDE_ANNOTATION = os.getenv("KEY_EXCLUDE_ANNOTATION", "k8s-sidecar-key-exclude")
+
+# Guardrails against unwanted or oversized objects. Sizes are in bytes of the values as stored in the object
+# (base64 encoded for secrets and binaryData), 0 disables the check.
+SECRET_TYPES = {t.strip() for t in os.getenv("SECRET_TYPES", "").split(",") if t.strip()}
+MAX_KEY_SIZE = int(os.getenv("MAX_KEY_SIZE", 0))
+MAX_OBJECT_SIZE = int(os.getenv("MAX_OBJECT_SIZE", 0))
+
+# Annotation with the priority of an object in the initial sync, objects with higher priorities are written first.
+# Unset keeps the order of the API, which lets the initial sync stream the objects.
+PRIORITY_ANNOTATION = os.getenv("PRIORITY_ANNOTATION")
 
 # Get logger
 logger = get_logger()
@@ -71,6 +129,76 @@ def prepare_payload(payload):
         logger.warning(f"Payload will be posted as quoted json")
         return payload
 
+_content_store = None
+
+
+def set_content_store(store):
+    """
+    Publish every file written from now on to the store of the content API, None stops publishing.
+    """
+    global _content_store
+    _content_store = store
+
+
+def _core_v1_api():
+    """
+    Return the API to read the objects from, the node-level daemon if DAEMON_SOCKET is set.
+    """
+    if uses_daemon():
+        from daemon import DaemonApi
+        return DaemonApi()
+    return rate_limited(client.CoreV1Api(api_client=get_api_client()))
+
+
+def _get_shard(state_map, resource, scope):
+    """
+    Return the slice of a state map owned by the watcher of the given scope, creating it if needed.
+    """
+    shard = state_map[resource].get(scope)
+    if shard is None:
+        with _shards_lock:
+            shard = state_map[resource].setdefault(scope, {})
+    return shard
+
+
+def _scope(namespace, label_selector, pipeline=None):
+    scope = f"{namespace}/{label_selector}"
+    return scope if pipeline is None else f"{scope}#{pipeline.name}"
+
+
+def _selected_elsewhere(resource, scope, key):
+    """
+    Check whether an object is still selected by the watcher of another scope of the same pipeline,
+    e.g. by a second label selector, in which case its files must be kept when it leaves this scope.
+    """
+    pipeline = scope.partition("#")[2]
+    return any(key in objects for other, objects in list(_resources_object_map[resource].items())
+               if other != scope and other.partition("#")[2] == pipeline)
+
+
+def watched_label_selectors(resource, label_selectors, pipelines=None):
+    """
+    Return the label selectors to watch a resource with, the fewest covering every pipeline if pipelines are used.
+    """
+    if pipelines is None:
+        return label_selectors
+    return merge_label_selectors([selector for pipeline in pipelines if resource in pipeline.resources
+                                  for selector in pipeline.label_selectors])
+
+
+def _selectors(resource, label, label_value, label_selector):
+    """
+    Return the server-side label and field selector arguments of list and watch requests.
+    """
+    if label_selector is None:
+        label_selector = f"{label}={label_value}" if label_value else label
+    selectors = {'label_selector': label_selector}
+    field_selector = ",".join(s for s in (FIELD_SELECTOR, _resource_field_selectors[resource]) if s)
+    if field_selector:
+        selectors['field_selector'] = field_selector
+    return selectors
+
+
 def _get_file_data_and_name(full_filename, content, enable_5xx, content_type=CONTENT_TYPE_TEXT):
     if content_type == CONTENT_TYPE_BASE64_BINARY:
         file_data = base64.b64decode(content)
@@ -99,36 +227,253 @@ def _get_destination_folder(metadata, default_folder, folder_annotation):
             dest_folder = folder_annotation
         else:
             dest_folder = os.path.join(default_folder, folder_annotation)
-        logger.info(f"Found a folder override annotation, "
-                    f"placing the {metadata.name} in: {dest_folder}")
+        logger.info("Found a folder override annotation, "
+                    "placing the %s in: %s", metadata.name, dest_folder)
         return dest_folder
     return default_folder
 
-def _iter_k8s_items(list_fn, *, limit=5, **kwargs):
+@lru_cache(maxsize=256)
+def _compile_key_patterns(patterns):
+    """
+    Compile comma separated globs and "re:" prefixed regular expressions into a single pattern.
     """
-    Iterate over k8s list_* results, handling pagination under the hood.
+    if not patterns:
+        return None
+    expressions = []
+    for pattern in patterns.split(","):
+        pattern = pattern.strip()
+        if pattern.startswith("re:"):
+            expressions.append(f"(?:{pattern[3:]})")
+        elif pattern:
+            expressions.append(fnmatch.translate(pattern))
+    return re.compile("|".join(expressions)) if expressions else None
+
+
+def check_key_patterns():
+    """
+    Return the error of the KEY_INCLUDE and KEY_EXCLUDE patterns, or None if they are valid.
+    """
+    for name, patterns in (("KEY_INCLUDE", KEY_INCLUDE), ("KEY_EXCLUDE", KEY_EXCLUDE)):
+        try:
+            _compile_key_patterns(patterns)
+        except re.error as e:
+            return f"Invalid pattern in {name} {patterns!r}: {e}"
+    return None
+
+
+@lru_cache(maxsize=256)
+def _object_key_filter(namespace, name, include_patterns, exclude_patterns):
+    # Cached per object, so an invalid annotation is only reported once and not for every data key
+    try:
+        include = _compile_key_patterns(include_patterns)
+        exclude = _compile_key_patterns(exclude_patterns)
+    except re.error as e:
+        logger.warning(f"Ignoring the key patterns of {namespace}/{name}, using KEY_INCLUDE and KEY_EXCLUDE "
+                       f"instead: {e}")
+        record_skip("key_pattern")
+        include = _compile_key_patterns(KEY_INCLUDE)
+        exclude = _compile_key_patterns(KEY_EXCLUDE)
+    if include is None and exclude is None:
+        return None
+    return include, exclude
+
+
+def _key_filter(metadata):
+    """
+    Return the include and exclude patterns for the data keys of an object, or None if every key is written.
+    Invalid patterns of the annotations fall back to KEY_INCLUDE and KEY_EXCLUDE.
+    """
+    annotations = metadata.annotations or {}
+    return _object_key_filter(metadata.namespace, metadata.name,
+                              annotations.get(KEY_INCLUDE_ANNOTATION, KEY_INCLUDE),
+                              annotations.get(KEY_EXCLUDE_ANNOTATION, KEY_EXCLUDE))
+
+
+def _is_key_selected(data_key, key_filter):
+    if key_filter is None:
+        return True
+    include, exclude = key_filter
+    return (include is None or include.fullmatch(data_key) is not None) and \
+        (exclude is None or exclude.fullmatch(data_key) is None)
+
+
+def _is_object_allowed(obj, resource):
+    """
+    Check the guardrails which apply to a whole object, before anything of it is copied or written.
+    """
+    metadata = obj.metadata
+    if resource == RESOURCE_SECRET and SECRET_TYPES and (obj.type or "Opaque") not in SECRET_TYPES:
+        logger.warning("Skipping secret %s/%s of type %s, allowed types are %s",
+                       metadata.namespace, metadata.name, obj.type, ",".join(sorted(SECRET_TYPES)))
+        record_skip("secret_type")
+        return False
+    if MAX_OBJECT_SIZE:
+        size = sum(len(value or "")
+                   for data in (obj.data, getattr(obj, "binary_data", None)) if data
+                   for value in data.values())
+        if size > MAX_OBJECT_SIZE:
+            logger.warning("Skipping %s %s/%s, its data is %d bytes and exceeds MAX_OBJECT_SIZE (%d)",
+                           resource, metadata.namespace, metadata.name, size, MAX_OBJECT_SIZE)
+            record_skip("object_size")
+            return False
+    return True
+
+
+def _priority(item):
+    priority = (item.metadata.annotations or {}).get(PRIORITY_ANNOTATION)
+    if priority is None:
+        return 0
+    try:
+        return int(priority)
+    except ValueError:
+        logger.warning(f"Ignoring invalid {PRIORITY_ANNOTATION} {priority!r} of "
+                       f"{item.metadata.namespace}/{item.metadata.name}")
+        return 0
+
+
+def _iter_k8s_items(list_fn, *, limit=5, resource_version=None, resource_version_match=None, list_meta=None,
+                    **kwargs):
+    """
+    Iterate over k8s list_* results, handling pagination under the hood. The resource version only applies
+    to the first page, the continue token pins the following pages to the same snapshot. The collection's
+    resource version is stored under "resource_version" of list_meta, if given.
     """
     continue_token = None
+    version_args = {}
+    if resource_version is not None:
+        version_args["resource_version"] = resource_version
+        if resource_version_match:
+            version_args["resource_version_match"] = resource_version_match
 
     while True:
-        resp = list_fn(limit=limit, _continue=continue_token, **kwargs)
+        if RAW_JSON_DECODING:
+            resp = list_fn(limit=limit, _continue=continue_token, _preload_content=False, **version_args, **kwargs)
+            content = json.loads(resp.data)
+            items = map(ResourceRecord.from_dict, content.get("items") or ())
+            continue_token = (content.get("metadata") or {}).get("continue")
+            collection_version = (content.get("metadata") or {}).get("resourceVersion")
+        else:
+            resp = list_fn(limit=limit, _continue=continue_token, **version_args, **kwargs)
+            items = resp.items
+            continue_token = getattr(resp.metadata, "_continue", None)
+            collection_version = getattr(resp.metadata, "resource_version", None)
+        version_args = {}
+        # A long initial sync must not look like lost contact to the liveness check
+        update_k8s_contact()
+        if list_meta is not None and collection_version and "resource_version" not in list_meta:
+            list_meta["resource_version"] = collection_version
 
         # Yield each item from this page
-        for item in resp.items:
+        for item in items:
             yield item
 
         # Check if there is another page
-        continue_token = getattr(resp.metadata, "_continue", None)
         if not continue_token:
             break
 
 
+def _list_version_args(resource, scope):
+    """
+    Return the resource version arguments of the first LIST page of a scope, as set by LIST_RESOURCE_VERSION.
+    NotOlderThan needs a version to compare with, so the first LIST of a scope falls back to "0".
+    """
+    if LIST_RESOURCE_VERSION == "0":
+        return {"resource_version": "0"}
+    if LIST_RESOURCE_VERSION == "NotOlderThan":
+        known_version = _list_resource_versions[resource].get(scope)
+        if known_version is None:
+            return {"resource_version": "0"}
+        return {"resource_version": known_version, "resource_version_match": "NotOlderThan"}
+    return {}
+
+
+def _stream_raw_events(list_fn, bookmarks=False, **kwargs):
+    """
+    Watch a list_* endpoint and yield its events with ResourceRecords as objects,
+    parsing the line-delimited JSON stream directly. Bookmarks are skipped, unless
+    asked for, in which case their object is the plain dict as in watch.Watch().stream().
+    """
+    resp = list_fn(watch=True, _preload_content=False, **kwargs)
+    try:
+        for line in iter_resp_lines(resp):
+            if not line:
+                continue
+            event = json.loads(line)
+            event_type = event.get("type")
+            obj = event.get("object") or {}
+            if event_type == "ERROR":
+                raise ApiException(status=obj.get("code"), reason=f"{obj.get('reason')}: {obj.get('message')}")
+            if event_type == "BOOKMARK":
+                if bookmarks:
+                    yield {"type": event_type, "object": obj}
+                continue
+            yield {"type": event_type, "object": ResourceRecord.from_dict(obj)}
+    finally:
+        resp.close()
+        resp.release_conn()
+
+
+def disable_watch_list(reason):
+    global WATCH_LIST
+    if WATCH_LIST:
+        logger.warning(f"WATCH_LIST disabled, falling back to paginated LIST requests: {reason}")
+        WATCH_LIST = False
+
+
+def _iter_watch_list_items(list_fn, *, resource_version=None, resource_version_match=None, list_meta=None,
+                           **kwargs):
+    """
+    Iterate over the current objects of a list_* endpoint streamed as a WatchList. The stream is closed at the
+    initial-events-end bookmark, whose resource version is stored under "resource_version" of list_meta.
+    Falls back to paginated LIST requests if the apiserver rejects the WatchList.
+    """
+    watch_args = dict(kwargs, send_initial_events=True, resource_version_match="NotOlderThan",
+                      allow_watch_bookmarks=True, timeout_seconds=WATCH_SERVER_TIMEOUT,
+                      _request_timeout=WATCH_CLIENT_TIMEOUT)
+    if resource_version is not None:
+        watch_args["resource_version"] = resource_version
+    if RAW_JSON_DECODING:
+        events = _stream_raw_events(list_fn, bookmarks=True, **watch_args)
+    else:
+        events = watch.Watch().stream(list_fn, **watch_args)
+
+    try:
+        event = next(events, None)
+    except ApiException as e:
+        # Rejected by apiservers without the WatchList feature
+        if e.status not in (400, 403, 422):
+            raise
+        disable_watch_list(e.reason)
+        yield from _iter_k8s_items(list_fn, limit=5, resource_version=resource_version,
+                                   resource_version_match=resource_version_match, list_meta=list_meta, **kwargs)
+        return
+
+    try:
+        while event is not None:
+            update_k8s_contact()
+            if event["type"] == "BOOKMARK":
+                metadata = event["object"].get("metadata") or {}
+                if (metadata.get("annotations") or {}).get(INITIAL_EVENTS_END_ANNOTATION) == "true":
+                    if list_meta is not None:
+                        list_meta["resource_version"] = metadata.get("resourceVersion")
+                    return
+            elif event["type"] == "ADDED":
+                yield event["object"]
+            event = next(events, None)
+    finally:
+        events.close()
+    raise ApiException(reason="WatchList ended before all objects were sent, consider raising WATCH_SERVER_TIMEOUT")
+
+
 def list_resources(label, label_value, target_folder, request_url, request_method, request_payload,
                    namespace, folder_annotation, resource, unique_filenames, script, enable_5xx,
-                   ignore_already_processed, resource_name):
+                   ignore_already_processed, resource_name, label_selector=None, pipelines=None,
+                   initial_sync=False):
     _initialize_kubeclient_configuration()
-    v1 = client.CoreV1Api(api_client=get_api_client())
+    v1 = _core_v1_api()
 
+    selectors = _selectors(resource, label, label_value, label_selector)
+    scope = _scope(namespace, selectors['label_selector'])
     additional_args = {}
 
     if namespace != "ALL":
@@ -137,6 +482,7 @@ def list_resources(label, label_value, target_folder, request_url, request_metho
     logger.info(f"Performing list-based sync on {resource} resources: {additional_args}")
 
     resource_names = []
+    list_meta = {}
 
     if namespace != "ALL" and resource_name:
         for rn in resource_name.split(","):
@@ -153,19 +499,32 @@ def list_resources(label, label_value, target_folder, request_url, request_metho
             additional_args['name'] = rn
             try:
                 ret = getattr(v1, _read_namespace[resource])(**additional_args)
+                update_k8s_contact()
                 items.append(ret)
             except ApiException as e:
                 if e.status != 404:
                     raise e
 
     else:
-        additional_args['label_selector'] = f"{label}={label_value}" if label_value else label
+        additional_args.update(selectors)
 
         list_fn = getattr(v1, _list_namespace[namespace][resource])
-        items = _iter_k8s_items(list_fn, limit=5, **additional_args)
+        if WATCH_LIST:
+            items = _iter_watch_list_items(list_fn, list_meta=list_meta, **_list_version_args(resource, scope),
+                                           **additional_args)
+        else:
+            items = _iter_k8s_items(list_fn, limit=5, list_meta=list_meta, **_list_version_args(resource, scope),
+                                    **additional_args)
+
+    if initial_sync and PRIORITY_ANNOTATION:
+        # Sorting needs every object of the LIST before the first file is written, which holds all of them
+        # in memory next to their copies in the object cache. Without priorities, objects are streamed.
+        items = sorted(items, key=_priority, reverse=True)
 
-    files_changed = False
+    files_changed = FileChanges()
+    changed_pipelines = defaultdict(FileChanges)
     exist_keys = set()
+    resources_versions = _get_shard(_resources_version_map, resource, scope)
 
     # For all the found resources
     for item in items:
@@ -175,59 +534,129 @@ def list_resources(label, label_value, target_folder, request_url, request_metho
         # Ignore already processed resource
         # Avoid numerous logs about useless resource processing each time the LIST loop reconnects
         if ignore_already_processed:
-            if _resources_version_map[resource].get(metadata.namespace + metadata.name) == metadata.resource_version:
-                logger.debug(f"Ignoring {resource} {metadata.namespace}/{metadata.name}")
+            if resources_versions.get(metadata.namespace + metadata.name) == metadata.resource_version:
+                logger.debug("Ignoring %s %s/%s", resource, metadata.namespace, metadata.name)
                 continue
 
-            _resources_version_map[resource][metadata.namespace + metadata.name] = metadata.resource_version
+            resources_versions[metadata.namespace + metadata.name] = metadata.resource_version
 
-        logger.debug(f"Working on {resource}: {metadata.namespace}/{metadata.name}")
+        logger.debug("Working on %s: %s/%s", resource, metadata.namespace, metadata.name)
+
+        if pipelines is not None:
+            for pipeline, changes in _dispatch(item, False, resource, namespace, selectors['label_selector'],
+                                               pipelines).items():
+                changed_pipelines[pipeline] |= changes
+            continue
 
         # Get the destination folder
         dest_folder = _get_destination_folder(metadata, target_folder, folder_annotation)
 
         if resource == RESOURCE_CONFIGMAP:
-            files_changed |= _process_config_map(dest_folder, item, resource, unique_filenames, enable_5xx)
+            files_changed |= _process_config_map(dest_folder, item, resource, scope, unique_filenames, enable_5xx)
         else:
-            files_changed |= _process_secret(dest_folder, item, resource, unique_filenames, enable_5xx)
-
-    # Clear the cache that is not listed. Scope the diff to this namespace: the cache is shared across per-namespace threads, so an unscoped diff would let one thread delete another's resources. 
-    resource_objects = _resources_object_map[resource].copy()
-    relevant_keys = {
-        key for key, item in resource_objects.items()
-        if namespace == "ALL" or item.metadata.namespace == namespace
-    }
-    for key in relevant_keys - exist_keys:
-        item = resource_objects.get(key)
-        if item is None:
-            continue  # another thread has already removed the key
+            files_changed |= _process_secret(dest_folder, item, resource, scope, unique_filenames, enable_5xx)
+
+    # Clear the cache that is not listed. The shard only holds objects seen by this scope's watcher,
+    # so the diff touches nothing that belongs to another thread.
+    for pipeline in pipelines or ():
+        pipeline_scope = _scope(namespace, selectors['label_selector'], pipeline)
+        pipeline_objects = _get_shard(_resources_object_map, resource, pipeline_scope)
+        for key in pipeline_objects.keys() - exist_keys:
+            changed_pipelines[pipeline] |= _process_object(None, pipeline_objects[key], resource, pipeline_scope,
+                                                           pipeline.unique_filenames, pipeline.enable_5xx, True)
+
+    resource_objects = _get_shard(_resources_object_map, resource, scope)
+    for key in resource_objects.keys() - exist_keys:
+        item = resource_objects[key]
         metadata = item.metadata
 
-        logger.debug(f"Removing {resource}: {metadata.namespace}/{metadata.name}")
+        logger.debug("Removing %s: %s/%s", resource, metadata.namespace, metadata.name)
 
         if resource == RESOURCE_CONFIGMAP:
-            files_changed |= _process_config_map(None, item, resource, unique_filenames, enable_5xx, True)
+            files_changed |= _process_config_map(None, item, resource, scope, unique_filenames, enable_5xx, True)
         else:
-            files_changed |= _process_secret(None, item, resource, unique_filenames, enable_5xx, True)
+            files_changed |= _process_secret(None, item, resource, scope, unique_filenames, enable_5xx, True)
+
+    if list_meta.get("resource_version"):
+        _list_resource_versions[resource][scope] = list_meta["resource_version"]
+    _finish_batch()
+    notify_pipelines(changed_pipelines)
 
     if script and files_changed:
-        execute(script)
+        execute(script, files_changed)
 
     if request_url and files_changed:
-        request(request_url, request_method, enable_5xx, request_payload)
+        request(request_url, request_method, enable_5xx, render_payload(request_payload, files_changed))
+
+
+def _dispatch(item, removed, resource, namespace, label_selector, pipelines):
+    """
+    Route an object of a shared watch to every pipeline selecting it. Pipelines which selected a previous
+    version of the object but don't match its labels anymore remove their files. Returns the FileChanges
+    of every pipeline whose files changed.
+    """
+    changed_pipelines = {}
+    metadata = item.metadata
+    key = metadata.namespace + metadata.name
+    for pipeline in pipelines:
+        scope = _scope(namespace, label_selector, pipeline)
+        selected = not removed and pipeline.matches(resource, metadata.labels)
+        if not selected and key not in _get_shard(_resources_object_map, resource, scope):
+            continue
+        dest_folder = None
+        if selected:
+            dest_folder = _get_destination_folder(metadata, pipeline.target_folder, pipeline.folder_annotation)
+        changes = _process_object(dest_folder, item, resource, scope, pipeline.unique_filenames,
+                                  pipeline.enable_5xx, not selected)
+        if changes:
+            changed_pipelines[pipeline] = changes
+    return changed_pipelines
+
+
+def notify_pipelines(changed_pipelines):
+    """
+    Run the script and send the request of every pipeline whose files changed, given as {pipeline: FileChanges}.
+    """
+    for pipeline in sorted(changed_pipelines, key=lambda p: p.name):
+        changes = changed_pipelines[pipeline]
+        if not changes:
+            continue
+        if pipeline.script:
+            execute(pipeline.script, changes)
+        if pipeline.request_url:
+            request(pipeline.request_url, pipeline.request_method, pipeline.enable_5xx,
+                    render_payload(pipeline.request_payload, changes))
+
 
+def _process_object(dest_folder, item, resource, scope, unique_filenames, enable_5xx, is_removed=False):
+    if resource == RESOURCE_CONFIGMAP:
+        return _process_config_map(dest_folder, item, resource, scope, unique_filenames, enable_5xx, is_removed)
+    return _process_secret(dest_folder, item, resource, scope, unique_filenames, enable_5xx, is_removed)
 
-def _process_secret(dest_folder, secret, resource, unique_filenames, enable_5xx, is_removed=False):
-    files_changed = False
 
-    old_secret = _resources_object_map[resource].get(secret.metadata.namespace + secret.metadata.name) or copy.deepcopy(secret)
-    old_dest_folder = _resources_dest_folder_map[resource].get(secret.metadata.namespace + secret.metadata.name) or dest_folder
+def _process_secret(dest_folder, secret, resource, scope, unique_filenames, enable_5xx, is_removed=False):
+    files_changed = FileChanges()
+    key = secret.metadata.namespace + secret.metadata.name
+    resource_objects = _get_shard(_resources_object_map, resource, scope)
+    resource_dest_folders = _get_shard(_resources_dest_folder_map, resource, scope)
+
     if is_removed:
-        dest_folder = old_dest_folder
-        _resources_object_map[resource].pop(secret.metadata.namespace + secret.metadata.name, None)
-    else:
-        _resources_object_map[resource][secret.metadata.namespace + secret.metadata.name] = copy.deepcopy(secret)
-        _resources_dest_folder_map[resource][secret.metadata.namespace + secret.metadata.name] = dest_folder
+        resource_objects.pop(key, None)
+        old_dest_folder = resource_dest_folders.pop(key, None)
+        if _selected_elsewhere(resource, scope, key):
+            logger.debug("Keeping files of %s %s, it is still selected by another watcher", resource, key)
+            return files_changed
+        return _remove_object_files(secret.metadata, resource, old_dest_folder)
+
+    if not _is_object_allowed(secret, resource):
+        # Keep whatever was written for a previous version of the object
+        return files_changed
+
+    old_secret = resource_objects.get(key) or copy.deepcopy(secret)
+    old_dest_folder = resource_dest_folders.get(key) or dest_folder
+    resource_objects[key] = copy.deepcopy(secret)
+    resource_dest_folders[key] = dest_folder
+    track_object(resource, secret.metadata.namespace, secret.metadata.name)
 
     if secret.data is None:
         logger.warning(f"No data field in {resource}")
@@ -240,12 +669,13 @@ def _process_secret(dest_folder, secret, resource, unique_filenames, enable_5xx,
             resource,
             unique_filenames,
             CONTENT_TYPE_BASE64_BINARY,
-            enable_5xx,
-            is_removed)
-    if old_secret.data is not None and not is_removed:
+            enable_5xx)
+    if old_secret.data is not None:
         if old_dest_folder == dest_folder:
+            key_filter = _key_filter(secret.metadata)
             for key in set(old_secret.data.keys()) & set(secret.data or {}):
-                old_secret.data.pop(key)
+                if _is_key_selected(key, key_filter):
+                    old_secret.data.pop(key)
         files_changed |= _iterate_data(
             old_secret.data,
             old_dest_folder,
@@ -258,23 +688,35 @@ def _process_secret(dest_folder, secret, resource, unique_filenames, enable_5xx,
     return files_changed
 
 
-def _process_config_map(dest_folder, config_map, resource, unique_filenames, enable_5xx, is_removed=False):
-    files_changed = False
+def _process_config_map(dest_folder, config_map, resource, scope, unique_filenames, enable_5xx, is_removed=False):
+    files_changed = FileChanges()
+    key = config_map.metadata.namespace + config_map.metadata.name
+    resource_objects = _get_shard(_resources_object_map, resource, scope)
+    resource_dest_folders = _get_shard(_resources_dest_folder_map, resource, scope)
 
-    old_config_map = _resources_object_map[resource].get(config_map.metadata.namespace + config_map.metadata.name) or copy.deepcopy(config_map)
-    old_dest_folder = _resources_dest_folder_map[resource].get(config_map.metadata.namespace + config_map.metadata.name) or dest_folder
     if is_removed:
-        dest_folder = old_dest_folder
-        _resources_object_map[resource].pop(config_map.metadata.namespace + config_map.metadata.name, None)
-    else:
-        _resources_object_map[resource][config_map.metadata.namespace + config_map.metadata.name] = copy.deepcopy(config_map)
-        _resources_dest_folder_map[resource][config_map.metadata.namespace + config_map.metadata.name] = dest_folder
+        resource_objects.pop(key, None)
+        old_dest_folder = resource_dest_folders.pop(key, None)
+        if _selected_elsewhere(resource, scope, key):
+            logger.debug("Keeping files of %s %s, it is still selected by another watcher", resource, key)
+            return files_changed
+        return _remove_object_files(config_map.metadata, resource, old_dest_folder)
+
+    if not _is_object_allowed(config_map, resource):
+        # Keep whatever was written for a previous version of the object
+        return files_changed
+
+    old_config_map = resource_objects.get(key) or copy.deepcopy(config_map)
+    old_dest_folder = resource_dest_folders.get(key) or dest_folder
+    resource_objects[key] = copy.deepcopy(config_map)
+    resource_dest_folders[key] = dest_folder
+    track_object(resource, config_map.metadata.namespace, config_map.metadata.name)
 
     if config_map.data is None and config_map.binary_data is None:
         logger.warning(f"No data/binaryData field in {resource}")
 
     if config_map.data is not None:
-        logger.debug(f"Found 'data' on {resource}")
+        logger.debug("Found 'data' on %s", resource)
         files_changed |= _iterate_data(
             config_map.data,
             dest_folder,
@@ -282,12 +724,13 @@ def _process_config_map(dest_folder, config_map, resource, unique_filenames, ena
             resource,
             unique_filenames,
             CONTENT_TYPE_TEXT,
-            enable_5xx,
-            is_removed)
-    if old_config_map.data is not None and not is_removed:
+            enable_5xx)
+    if old_config_map.data is not None:
         if old_dest_folder == dest_folder:
+            key_filter = _key_filter(config_map.metadata)
             for key in set(old_config_map.data.keys()) & set(config_map.data or {}):
-                old_config_map.data.pop(key)
+                if _is_key_selected(key, key_filter):
+                    old_config_map.data.pop(key)
         files_changed |= _iterate_data(
             old_config_map.data,
             old_dest_folder,
@@ -298,7 +741,7 @@ def _process_config_map(dest_folder, config_map, resource, unique_filenames, ena
             enable_5xx,
             True)
     if config_map.binary_data is not None:
-        logger.debug(f"Found 'binary_data' on {resource}")
+        logger.debug("Found 'binary_data' on %s", resource)
         files_changed |= _iterate_data(
             config_map.binary_data,
             dest_folder,
@@ -306,12 +749,13 @@ def _process_config_map(dest_folder, config_map, resource, unique_filenames, ena
             resource,
             unique_filenames,
             CONTENT_TYPE_BASE64_BINARY,
-            enable_5xx,
-            is_removed)
-    if old_config_map.binary_data is not None and not is_removed:
+            enable_5xx)
+    if old_config_map.binary_data is not None:
         if old_dest_folder == dest_folder:
+            key_filter = _key_filter(config_map.metadata)
             for key in set(old_config_map.binary_data.keys()) & set(config_map.binary_data or {}):
-                old_config_map.binary_data.pop(key)
+                if _is_key_selected(key, key_filter):
+                    old_config_map.binary_data.pop(key)
         files_changed |= _iterate_data(
             old_config_map.binary_data,
             old_dest_folder,
@@ -326,9 +770,19 @@ def _process_config_map(dest_folder, config_map, resource, unique_filenames, ena
 
 def _iterate_data(data, dest_folder, metadata, resource, unique_filenames, content_type, enable_5xx,
                   remove_files=False):
-    files_changed = False
+    files_changed = FileChanges()
+    key_filter = _key_filter(metadata)
     for data_key in data.keys():
+        if not _is_key_selected(data_key, key_filter):
+            logger.debug("Skipping key %s of %s/%s", data_key, metadata.namespace, metadata.name)
+            continue
         data_content = data[data_key]
+        if MAX_KEY_SIZE and len(data_content or "") > MAX_KEY_SIZE:
+            if not remove_files:
+                logger.warning("Skipping key %s of %s/%s, its value is %d bytes and exceeds MAX_KEY_SIZE (%d)",
+                               data_key, metadata.namespace, metadata.name, len(data_content), MAX_KEY_SIZE)
+                record_skip("key_size")
+            continue
         files_changed |= _update_file(
             data_key,
             data_content,
@@ -354,35 +808,152 @@ def _update_file(data_key, data_content, dest_folder, metadata, resource,
                                        namespace=metadata.namespace,
                                        resource=resource,
                                        resource_name=metadata.name)
+        path = os.path.join(dest_folder, filename)
         if not remove:
-            return write_data_to_file(dest_folder, filename, file_data, content_type)
+            existed = is_recorded(resource, metadata.namespace, metadata.name, path)
+            if is_repairing():
+                with file_lock(path):
+                    written = get_sink().write(dest_folder, filename, file_data, content_type)
+                    track_file(path, file_data,
+                               (resource, metadata.namespace, metadata.name, data_key, content_type, enable_5xx))
+            else:
+                written = get_sink().write(dest_folder, filename, file_data, content_type)
+            record_file(resource, metadata.namespace, metadata.name, path)
+            if _content_store is not None:
+                _content_store.publish(os.path.abspath(path), file_data, resource, metadata)
+            if written:
+                return FileChanges.of(MODIFIED if existed else ADDED, path, resource, metadata)
         else:
-            return remove_file(dest_folder, filename)
+            forget_file(resource, metadata.namespace, metadata.name, path)
+            if _remove_owned_file(dest_folder, filename):
+                return FileChanges.of(REMOVED, path, resource, metadata)
     except Exception:
         logger.exception(f"Error when updating from '%s' into '%s'", data_key, dest_folder)
+    return FileChanges()
+
+
+def _remove_object_files(metadata, resource, folder=None):
+    """
+    Remove every file the manifest recorded for a deleted object, only those in folder if it is known.
+    """
+    files_changed = FileChanges()
+    for path in sorted(forget_object(resource, metadata.namespace, metadata.name, folder)):
+        if _remove_owned_file(os.path.dirname(path), os.path.basename(path)):
+            files_changed |= FileChanges.of(REMOVED, path, resource, metadata)
+    return files_changed
+
+
+def _remove_owned_file(folder, filename):
+    if _content_store is not None:
+        _content_store.withdraw(os.path.abspath(os.path.join(folder, filename)))
+    if not is_repairing():
+        return get_sink().remove(folder, filename)
+    with file_lock(os.path.join(folder, filename)):
+        untrack_file(os.path.join(folder, filename))
+        return get_sink().remove(folder, filename)
+
+
+def repair_file(path, source):
+    """
+    Write a drifted file again from the cached object it was written from. Only called once the file differs
+    from the content last written, so URLs are fetched again for actual drift only.
+    """
+    resource, namespace, name, data_key, content_type, enable_5xx = source
+    content = _cached_content(resource, namespace, name, data_key, content_type)
+    if content is None:
+        logger.debug("Not repairing %s, %s %s/%s isn't cached anymore", path, resource, namespace, name)
         return False
+    _, file_data = _get_file_data_and_name(data_key, content, enable_5xx, content_type)
+    written = get_sink().write(os.path.dirname(path), os.path.basename(path), file_data, content_type)
+    track_file(path, file_data, source)
+    return written
+
+
+def _cached_content(resource, namespace, name, data_key, content_type):
+    """
+    Return the value of a data key of a cached object, from whichever watcher holds it.
+    """
+    key = namespace + name
+    for objects in list(_resources_object_map[resource].values()):
+        obj = objects.get(key)
+        if obj is None:
+            continue
+        binary = resource == RESOURCE_CONFIGMAP and content_type == CONTENT_TYPE_BASE64_BINARY
+        data = obj.binary_data if binary else obj.data
+        if data and data_key in data:
+            return data[data_key]
+    return None
+
+
+def _finish_batch():
+    """
+    Flush the output sink and persist the manifest once a batch of changes has been processed.
+    """
+    get_sink().flush()
+    save_manifest()
+
+
+def cache_stats():
+    """
+    Return the number of cached objects per resource and watched namespace.
+    """
+    return {
+        f"{resource}/{namespace}": len(objects)
+        for resource, shards in _resources_object_map.items()
+        for namespace, objects in list(shards.items())
+    }
+
+
+def remove_orphaned_files():
+    """
+    Remove files recorded in a persisted manifest whose objects were not seen during the initial sync,
+    e.g. because they were deleted while the sidecar was not running. The files are removed through the
+    output sink like those of deleted objects. Returns the FileChanges.
+    """
+    live_objects = {
+        (resource, item.metadata.namespace, item.metadata.name)
+        for resource, shards in _resources_object_map.items()
+        for objects in list(shards.values())
+        for item in list(objects.values())
+    }
+    files_removed = FileChanges()
+    for path, owner in sorted(forget_orphans(live_objects).items()):
+        logger.info(f"Removing orphaned file {path}")
+        if _remove_owned_file(os.path.dirname(path), os.path.basename(path)):
+            files_removed.removed[path] = owner + (None,)
+    _finish_batch()
+    return files_removed
 
 def _watch_resource_iterator(label, label_value, target_folder, request_url, request_method, request_payload,
                              namespace, folder_annotation, resource, unique_filenames, script, enable_5xx,
-                             ignore_already_processed):
+                             ignore_already_processed, heartbeat=None, label_selector=None, pipelines=None):
     _initialize_kubeclient_configuration()
-    v1 = client.CoreV1Api(api_client=get_api_client())
-    # Filter resources based on label and value or just label
-    label_selector = f"{label}={label_value}" if label_value else label
-
-    additional_args = {
-        'label_selector': label_selector,
+    v1 = _core_v1_api()
+    # Filter resources server-side on their labels and fields
+    additional_args = _selectors(resource, label, label_value, label_selector)
+    scope = _scope(namespace, additional_args['label_selector'])
+    additional_args.update({
         'timeout_seconds': WATCH_SERVER_TIMEOUT,
         '_request_timeout': WATCH_CLIENT_TIMEOUT,
-    }
+    })
     if namespace != "ALL":
         additional_args['namespace'] = namespace
+    if WATCH_LIST:
+        # Resume from the WatchList of the initial sync once, later connections replay every object as before
+        resume_version = _list_resource_versions[resource].pop(scope, None)
+        if resume_version:
+            additional_args['resource_version'] = resume_version
 
     logger.debug(f"Performing watch-based sync on {resource} resources: {additional_args}")
 
-    stream = watch.Watch().stream(getattr(v1, _list_namespace[namespace][resource]), **additional_args)
+    list_fn = getattr(v1, _list_namespace[namespace][resource])
+    if RAW_JSON_DECODING:
+        stream = _stream_raw_events(list_fn, **additional_args)
+    else:
+        stream = watch.Watch().stream(list_fn, **additional_args)
 
     first_event = True
+    resources_versions = _get_shard(_resources_version_map, resource, scope)
 
     # Process events
     for event in stream:
@@ -394,85 +965,136 @@ def _watch_resource_iterator(label, label_value, target_folder, request_url, req
         metadata = item.metadata
         event_type = event['type']
 
-        update_k8s_contact()  # To be sure that every event received is counted as “K8s alive”
+        # To be sure that every event received is counted as “K8s alive”
+        if heartbeat:
+            heartbeat.event_received()
+        else:
+            update_k8s_contact()
 
         # Ignore already processed resource
         # Avoid numerous logs about useless resource processing each time the WATCH loop reconnects
         if ignore_already_processed:
-            if _resources_version_map[resource].get(metadata.namespace + metadata.name) == metadata.resource_version:
+            if resources_versions.get(metadata.namespace + metadata.name) == metadata.resource_version:
                 if event_type == "ADDED" or event_type == "MODIFIED":
-                    logger.debug(f"Ignoring {event_type} {resource} {metadata.namespace}/{metadata.name}")
+                    logger.debug("Ignoring %s %s %s/%s", event_type, resource, metadata.namespace, metadata.name)
+                    if heartbeat:
+                        heartbeat.event_processed()
                     continue
                 elif event_type == "DELETED":
-                    _resources_version_map[resource].pop(metadata.namespace + metadata.name)
+                    resources_versions.pop(metadata.namespace + metadata.name)
 
             if event_type == "ADDED" or event_type == "MODIFIED":
-                _resources_version_map[resource][metadata.namespace + metadata.name] = metadata.resource_version
+                resources_versions[metadata.namespace + metadata.name] = metadata.resource_version
+
+        logger.debug("Working on %s %s %s/%s", event_type, resource, metadata.namespace, metadata.name)
 
-        logger.debug(f"Working on {event_type} {resource} {metadata.namespace}/{metadata.name}")
+        if pipelines is not None:
+            changed_pipelines = _dispatch(item, event_type == "DELETED", resource, namespace,
+                                          additional_args['label_selector'], pipelines)
+            _finish_batch()
+            notify_pipelines(changed_pipelines)
+            if heartbeat:
+                heartbeat.event_processed()
+            continue
 
-        files_changed = False
+        files_changed = FileChanges()
 
         # Get the destination folder
         dest_folder = _get_destination_folder(metadata, target_folder, folder_annotation)
 
         item_removed = event_type == "DELETED"
         if resource == RESOURCE_CONFIGMAP:
-            files_changed |= _process_config_map(dest_folder, item, resource, unique_filenames, enable_5xx,
+            files_changed |= _process_config_map(dest_folder, item, resource, scope, unique_filenames, enable_5xx,
                                                  item_removed)
         else:
-            files_changed |= _process_secret(dest_folder, item, resource, unique_filenames, enable_5xx, item_removed)
+            files_changed |= _process_secret(dest_folder, item, resource, scope, unique_filenames, enable_5xx,
+                                             item_removed)
+
+        _finish_batch()
 
         if script and files_changed:
-            execute(script)
+            execute(script, files_changed)
 
         if request_url and files_changed:
-            request(request_url, request_method, enable_5xx, request_payload)
+            request(request_url, request_method, enable_5xx, render_payload(request_payload, files_changed))
+
+        if heartbeat:
+            heartbeat.event_processed()
 
 
 def _watch_resource_loop(shutdown_event, mode, label, label_value, target_folder, request_url, request_method, request_payload,
                          namespace, folder_annotation, resource, unique_filenames, script, enable_5xx,
-                         ignore_already_processed, resource_name):
+                         ignore_already_processed, resource_name, label_selector=None, pipelines=None):
     _initialize_kubeclient_configuration()  # ensure k8s config in child
+    name = f"{namespace}/{resource}" if label_selector is None else f"{namespace}/{resource}[{label_selector}]"
+    heartbeat = register_watcher(name)
+    first_run = True
 
     while not shutdown_event.is_set():
+        if not first_run:
+            heartbeat.reconnected()
+        first_run = False
         try:
             if mode == "SLEEP" or (namespace != 'ALL' and resource_name):
                 list_resources(label, label_value, target_folder, request_url, request_method, request_payload,
                                namespace, folder_annotation, resource, unique_filenames, script, enable_5xx,
-                               ignore_already_processed, resource_name)
+                               ignore_already_processed, resource_name, label_selector, pipelines)
+                heartbeat.event_received()
+                heartbeat.event_processed()
                 sleep(int(os.getenv("SLEEP_TIME", 60)))
             else:
                 _watch_resource_iterator(label, label_value, target_folder, request_url, request_method, request_payload,
                                          namespace, folder_annotation, resource, unique_filenames, script, enable_5xx,
-                                         ignore_already_processed)
+                                         ignore_already_processed, heartbeat, label_selector, pipelines)
         except ApiException as e:
+            heartbeat.errors += 1
             if e.status != 500:
                 logger.error(f"ApiException when calling kubernetes: {e}\n")
-                sleep(int(os.getenv("ERROR_THROTTLE_SLEEP", 5)))
+                sleep(jittered(int(os.getenv("ERROR_THROTTLE_SLEEP", 5))))
             else:
                 raise
         except ProtocolError as e:
+            heartbeat.errors += 1
             logger.error(f"ProtocolError when calling kubernetes: {e}\n")
-            sleep(int(os.getenv("ERROR_THROTTLE_SLEEP", 5)))
+            sleep(jittered(int(os.getenv("ERROR_THROTTLE_SLEEP", 5))))
         except MaxRetryError as e:
+            heartbeat.errors += 1
             logger.error(f"MaxRetryError when calling kubernetes: {e}\n")
-            sleep(int(os.getenv("ERROR_THROTTLE_SLEEP", 5)))
+            sleep(jittered(int(os.getenv("ERROR_THROTTLE_SLEEP", 5))))
         except Exception as e:
+            heartbeat.errors += 1
             logger.error(f"Received unknown exception: {e}\n")
             traceback.print_exc()
-            sleep(int(os.getenv("ERROR_THROTTLE_SLEEP", 5)))
-    logger.info(f"Shutdown event received, stopping watcher for {namespace}/{resource}.")
+            sleep(jittered(int(os.getenv("ERROR_THROTTLE_SLEEP", 5))))
+    logger.info(f"Shutdown event received, stopping watcher for {name}.")
 
 
 def watch_for_changes(mode, label, label_value, target_folder, request_url, request_method, request_payload,
                       current_namespace, folder_annotation, resources, unique_filenames, script, enable_5xx,
-                      ignore_already_processed, resource_name):
+                      ignore_already_processed, resource_name, label_selectors=None, pipelines=None):
     shutdown_event = Event()
-    processes = _start_watcher_processes(shutdown_event, current_namespace, folder_annotation, label,
-                                         label_value, request_method, mode, request_payload, resources,
-                                         target_folder, unique_filenames, script, request_url, enable_5xx,
-                                         ignore_already_processed, resource_name)
+    if label_selectors is None:
+        label_selectors = [f"{label}={label_value}" if label_value else label]
+    worker_processes = int(os.getenv("WATCHER_PROCESSES", 0))
+    if worker_processes > 0 and not supports_worker_processes():
+        logger.warning("WATCHER_PROCESSES is not supported by the selected OUTPUT_SINK, using threads instead.")
+        worker_processes = 0
+    if worker_processes > 0 and _content_store is not None:
+        logger.warning("WATCHER_PROCESSES is not supported with CONTENT_API_PORT, using threads instead.")
+        worker_processes = 0
+    if worker_processes > 0 and is_repairing():
+        logger.warning("DRIFT_REPAIR is not supported with WATCHER_PROCESSES, drifted files won't be repaired.")
+        stop_drift_repair()
+    if worker_processes > 0:
+        processes = _start_worker_processes(worker_processes, current_namespace, folder_annotation, label,
+                                            label_value, request_method, mode, request_payload, resources,
+                                            target_folder, unique_filenames, script, request_url, enable_5xx,
+                                            ignore_already_processed, resource_name, label_selectors, pipelines)
+    else:
+        processes = _start_watcher_processes(shutdown_event, current_namespace, folder_annotation, label,
+                                             label_value, request_method, mode, request_payload, resources,
+                                             target_folder, unique_filenames, script, request_url, enable_5xx,
+                                             ignore_already_processed, resource_name, label_selectors, pipelines)
 
     procs_only = [p for p, ns, resource in processes]
     register_watcher_processes(procs_only)
@@ -485,6 +1107,7 @@ def watch_for_changes(mode, label, label_value, target_folder, request_url, requ
             if not proc.is_alive():
                 logger.error(f"Process for {ns}/{resource} died")
                 died = True
+        set_watchers_alive(not died)
         if died:
             logger.fatal("At least one process died. Stopping and exiting")
             shutdown_event.set()
@@ -499,18 +1122,82 @@ def watch_for_changes(mode, label, label_value, target_folder, request_url, requ
 
 def _start_watcher_processes(shutdown_event, namespace, folder_annotation, label, label_value, request_method,
                              mode, request_payload, resources, target_folder, unique_filenames, script, request_url,
-                             enable_5xx, ignore_already_processed, resource_name):
+                             enable_5xx, ignore_already_processed, resource_name, label_selectors, pipelines=None,
+                             selectors_resolved=False):
+    """
+    Start a watcher thread per resource, namespace and label selector. With selectors_resolved, label_selectors
+    are watched as given instead of being derived from the pipelines, e.g. by a worker process owning one of them.
+    """
     processes = []
     for resource in resources:
+        resource_label_selectors = (label_selectors if selectors_resolved
+                                    else watched_label_selectors(resource, label_selectors, pipelines))
         for ns in namespace.split(','):
-            proc = Thread(target=_watch_resource_loop,
-                           args=(shutdown_event, mode, label, label_value, target_folder, request_url, request_method, request_payload,
-                                 ns, folder_annotation, resource, unique_filenames, script, enable_5xx,
-                                 ignore_already_processed, resource_name)
-                           )
-            proc.daemon = True
-            proc.start()
-            processes.append((proc, ns, resource))
+            for label_selector in resource_label_selectors:
+                proc = Thread(target=_watch_resource_loop,
+                               args=(shutdown_event, mode, label, label_value, target_folder, request_url, request_method, request_payload,
+                                     ns, folder_annotation, resource, unique_filenames, script, enable_5xx,
+                                     ignore_already_processed, resource_name, label_selector, pipelines)
+                               )
+                proc.daemon = True
+                proc.start()
+                processes.append((proc, ns if len(resource_label_selectors) == 1 else f"{ns}[{label_selector}]",
+                                  resource))
+
+
+    return processes
 
 
+def _start_worker_processes(worker_processes, namespace, folder_annotation, label, label_value, request_method,
+                            mode, request_payload, resources, target_folder, unique_filenames, script, request_url,
+                            enable_5xx, ignore_already_processed, resource_name, label_selectors, pipelines=None):
+    """
+    Spread the (resource, namespace, label selector) watchers over separate worker processes, so that decoding
+    and hashing can use more than one CPU. Workers are forked after the initial sync and inherit its state.
+    """
+    pairs = [(resource, ns, label_selector)
+             for resource in resources for ns in namespace.split(',')
+             for label_selector in watched_label_selectors(resource, label_selectors, pipelines)]
+    worker_processes = min(worker_processes, len(pairs))
+    logger.info(f"Starting {worker_processes} worker processes for {len(pairs)} watchers")
+
+    import multiprocessing
+    context = multiprocessing.get_context("fork")
+    processes = []
+    for index in range(worker_processes):
+        worker_pairs = pairs[index::worker_processes]
+        proc = context.Process(target=_watch_worker_process,
+                               args=(index, worker_pairs, mode, label, label_value, target_folder, request_url,
+                                     request_method, request_payload, folder_annotation, unique_filenames, script,
+                                     enable_5xx, ignore_already_processed, resource_name, pipelines),
+                               name=f"watcher-worker-{index}")
+        proc.daemon = True
+        proc.start()
+        processes.append((proc,
+                          ",".join(sorted({ns for _, ns, _ in worker_pairs})),
+                          ",".join(sorted({resource for resource, _, _ in worker_pairs}))))
     return processes
+
+
+def _watch_worker_process(index, pairs, mode, label, label_value, target_folder, request_url, request_method,
+                          request_payload, folder_annotation, unique_filenames, script, enable_5xx,
+                          ignore_already_processed, resource_name, pipelines=None):
+    set_worker_index(index)
+    shutdown_event = Event()
+    threads = []
+    for resource, ns, label_selector in pairs:
+        threads += _start_watcher_processes(shutdown_event, ns, folder_annotation, label, label_value,
+                                            request_method, mode, request_payload, (resource,), target_folder,
+                                            unique_filenames, script, request_url, enable_5xx,
+                                            ignore_already_processed, resource_name, [label_selector], pipelines,
+                                            selectors_resolved=True)
+
+    while all(thread.is_alive() for thread, ns, resource in threads):
+        sleep(5)
+
+    for thread, ns, resource in threads:
+        if not thread.is_alive():
+            logger.error(f"Worker {index}: thread for {ns}/{resource} died")
+    shutdown_event.set()
+    # Exit with a non-zero status code so the main process notices
+    sys.exit(1)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import os
+import queue
+import signal
+import subprocess
+from threading import Lock, Thread
+
+from logger import get_logger
+
+# Keep SCRIPT running and hand it the triggers over stdin instead of starting it for every change
+SCRIPT_WORKER = os.getenv("SCRIPT_WORKER", "false").lower() == "true"
+# Seconds a script worker may take to answer a trigger before it is considered hung and restarted
+SCRIPT_WORKER_TIMEOUT = float(os.getenv("SCRIPT_WORKER_TIMEOUT", 60))
+
+# One worker per script path, e.g. for the scripts of several pipelines
+_workers = {}
+_workers_lock = Lock()
+
+# Get logger
+logger = get_logger()
+
+
+class ScriptWorker:
+    """
+    A long-lived script process handling one trigger after the other. A trigger is written to its stdin as
+    the "<A|M|D> <path>" lines of the changed files followed by an empty line. The script answers with a
+    single line on stdout once it is done, starting with "error" if it failed, and logs to stderr.
+    """
+
+    def __init__(self, script_path):
+        self.script_path = script_path
+        self.process = None
+        self.replies = None
+        self.lock = Lock()
+
+    def _start(self):
+        args = [self.script_path] if os.access(self.script_path, os.X_OK) else ["sh", self.script_path]
+        self.process = subprocess.Popen(args,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        env=dict(os.environ, SIDECAR_SCRIPT_WORKER="true"),
+                                        text=True,
+                                        bufsize=1,
+                                        start_new_session=True)
+        # Replies are read by a thread, so waiting for them can time out
+        self.replies = queue.Queue()
+        Thread(target=self._read_replies, args=(self.process, self.replies), daemon=True).start()
+        Thread(target=self._log_stderr, args=(self.process,), daemon=True).start()
+        logger.info(f"Started script worker {self.script_path} (pid {self.process.pid})")
+
+    @staticmethod
+    def _read_replies(process, replies):
+        for line in process.stdout:
+            replies.put(line.rstrip("\n"))
+        replies.put(None)
+
+    @staticmethod
+    def _log_stderr(process):
+        for line in process.stderr:
+            logger.debug("Script stderr: %s", line.rstrip("\n"))
+
+    def _stop(self):
+        if self.process is not None:
+            # Kill the whole process group, a hung script often waits for a child of its own
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.process.wait()
+            self.process = None
+
+    def _send(self, message):
+        # A worker that exited since the last trigger is restarted and gets the trigger once more
+        for _ in range(2):
+            if self.process is None or self.process.poll() is not None:
+                if self.process is not None:
+                    logger.error(f"Script worker {self.script_path} exited with {self.process.returncode}, "
+                                 "restarting it")
+                self._start()
+            try:
+                self.process.stdin.write(message)
+                self.process.stdin.flush()
+                return True
+            except OSError as e:
+                logger.error(f"Unable to send trigger to script worker {self.script_path}: {e}")
+                self._stop()
+        return False
+
+    def trigger(self, changes=None):
+        """
+        Hand the changes to the script and wait for its answer. Returns whether the script succeeded.
+        """
+        message = "".join(f"{line}\n" for line in changes.status_lines()) if changes else ""
+        with self.lock:
+            if not self._send(message + "\n"):
+                return False
+            try:
+                reply = self.replies.get(timeout=SCRIPT_WORKER_TIMEOUT)
+            except queue.Empty:
+                logger.error(f"Script worker {self.script_path} did not answer within {SCRIPT_WORKER_TIMEOUT}s, "
+                             "restarting it")
+                self._stop()
+                return False
+            if reply is None:
+                logger.error(f"Script worker {self.script_path} exited while handling a trigger")
+                self._stop()
+                return False
+        if reply.lower().startswith("error"):
+            logger.error(f"Script failed with error: {reply}")
+            return False
+        logger.debug("Script reply: %s", reply)
+        return True
+
+
+def run_in_worker(script_path, changes=None):
+    """
+    Trigger the worker of the script, starting it on first use.
+    """
+    with _workers_lock:
+        worker = _workers.get(script_path)
+        if worker is None:
+            worker = _workers[script_path] = ScriptWorker(script_path)
+    return worker.trigger(changes)
+
+
+def _forget_workers():
+    # Forked watcher processes start their own workers instead of sharing the pipes of the parent's
+    global _workers, _workers_lock
+    _workers = {}
+    _workers_lock = Lock()
+
+
+os.register_at_fork(after_in_child=_forget_workers)
@@ -4,10 +4,20 @@ import os, sys, re
 
 from kubernetes import client
 from kubernetes.client import ApiException
-from healthz import start_health_server, mark_ready
+from healthz import (is_ready_scope, mark_ready, mark_synced, register_sync_pipeline, register_sync_scope,
+                     start_health_server)
 from logger import get_logger
-from resources import list_resources, watch_for_changes, prepare_payload
-from client import _initialize_kubeclient_configuration, get_api_client
+from resources import (list_resources, watch_for_changes, prepare_payload, remove_orphaned_files, cache_stats,
+                       notify_pipelines, repair_file, set_content_store, check_key_patterns, watched_label_selectors,
+                       WATCH_LIST, disable_watch_list)
+from changes import FileChanges, PayloadTemplate, render_payload
+from helpers import execute, get_cli_args, request
+from label_selectors import get_label_selectors
+from manifest import load_manifest
+from pipelines import load_pipelines, pipeline_resources
+from sinks import FileSink, get_sink
+from drift import DRIFT_REPAIR, start_drift_repair
+from client import DAEMON_SOCKET, _initialize_kubeclient_configuration, get_api_client, uses_daemon
 
 METHOD                   = "METHOD"
 UNIQUE_FILENAMES         = "UNIQUE_FILENAMES"
@@ -15,15 +25,20 @@ FOLDER                   = "FOLDER"
 FOLDER_ANNOTATION        = "FOLDER_ANNOTATION"
 LABEL                    = "LABEL"
 LABEL_VALUE              = "LABEL_VALUE"
+LABEL_SELECTOR           = "LABEL_SELECTOR"
 RESOURCE                 = "RESOURCE"
 RESOURCE_NAME            = "RESOURCE_NAME"
 REQ_PAYLOAD              = "REQ_PAYLOAD"
+REQ_PAYLOAD_TEMPLATE     = "REQ_PAYLOAD_TEMPLATE"
 REQ_URL                  = "REQ_URL"
 REQ_METHOD               = "REQ_METHOD"
 REQ_SKIP_INIT            = "REQ_SKIP_INIT"
 SCRIPT                   = "SCRIPT"
 ENABLE_5XX               = "ENABLE_5XX"
 IGNORE_ALREADY_PROCESSED = "IGNORE_ALREADY_PROCESSED"
+PROFILE                  = "PROFILE"
+PIPELINES_CONFIG         = "PIPELINES_CONFIG"
+CONTENT_API_PORT         = "CONTENT_API_PORT"
 
 # Get logger
 logger = get_logger()
@@ -40,10 +55,54 @@ def exception_handler(exc_type, exc_value, exc_traceback):
 sys.excepthook = exception_handler
 
 
+def _route_changes(changes, pipelines):
+    """
+    Split changes into {pipeline: FileChanges}, each file going to the pipelines of its resource with the deepest
+    folder containing it. Files outside of every such folder, e.g. moved by an absolute folder annotation, go to
+    every pipeline of their resource.
+    """
+    routed = {pipeline: FileChanges() for pipeline in pipelines}
+    for kind, path, owner in changes.items():
+        candidates = [pipeline for pipeline in pipelines if owner[0] in pipeline.resources]
+        containing = [(len(folder), pipeline) for folder, pipeline in
+                      ((os.path.abspath(pipeline.target_folder), pipeline) for pipeline in candidates)
+                      if path.startswith(folder.rstrip(os.sep) + os.sep)]
+        if containing:
+            deepest = max(length for length, _ in containing)
+            candidates = [pipeline for length, pipeline in containing if length == deepest]
+        for pipeline in candidates:
+            getattr(routed[pipeline], kind)[path] = owner
+    return routed
+
+
+def _remove_orphans(script, request_url, request_method, enable_5xx, request_payload, pipelines=None):
+    logger.info("Removing files of objects deleted while the sidecar was not running.")
+    changes = remove_orphaned_files()
+    if changes:
+        if pipelines is not None:
+            notify_pipelines(_route_changes(changes, pipelines))
+            return
+        if script:
+            execute(script, changes)
+        if request_url:
+            request(request_url, request_method, enable_5xx, render_payload(request_payload, changes))
+
+
 def main():
+    # Validate the CLI flags before doing anything else
+    get_cli_args()
+
     logger.info("Starting collector")
 
     start_health_server()
+    # Optional features import their modules only when enabled, to keep the start fast
+    if os.getenv(CONTENT_API_PORT) and os.getenv(METHOD) != "DAEMON":
+        from content_api import start_content_api
+        set_content_store(start_content_api())
+
+    if os.getenv(PROFILE, "false").lower() == "true":
+        from profiler import start_profiler
+        start_profiler(cache_stats)
 
     folder_annotation = os.getenv(FOLDER_ANNOTATION)
     if folder_annotation is None:
@@ -51,17 +110,35 @@ def main():
                        "defaulting to k8s-sidecar-target-directory")
         folder_annotation = "k8s-sidecar-target-directory"
 
+    pipelines_config = os.getenv(PIPELINES_CONFIG)
+    if pipelines_config:
+        logger.info(f"Pipelines are configured in {pipelines_config}")
+
+    # The node-level daemon serves the objects to the sidecars instead of writing files
+    daemon_mode = os.getenv(METHOD) == "DAEMON"
+    if daemon_mode and not DAEMON_SOCKET:
+        logger.fatal("Should have added DAEMON_SOCKET as environment variable with METHOD=DAEMON! Exit")
+        return -1
+
+    key_patterns_error = check_key_patterns()
+    if key_patterns_error:
+        logger.fatal(f"{key_patterns_error}! Exit")
+        return -1
+
     label = os.getenv(LABEL)
-    if label is None:
-        logger.fatal("Should have added {LABEL} as environment variable! Exit")
+    if label is None and not os.getenv(LABEL_SELECTOR) and not pipelines_config and not daemon_mode:
+        logger.fatal(f"Should have added {LABEL} or {LABEL_SELECTOR} as environment variable! Exit")
         return -1
 
     label_value = os.getenv(LABEL_VALUE)
     if label_value:
         logger.debug(f"Filter labels with value: {label_value}")
 
+    label_selectors = get_label_selectors(label, label_value, os.getenv(LABEL_SELECTOR))
+    logger.debug(f"Selected label selectors: {label_selectors}")
+
     target_folder = os.getenv(FOLDER)
-    if target_folder is None:
+    if target_folder is None and not pipelines_config and not daemon_mode:
         logger.fatal(f"Should have added {FOLDER} as environment variable! Exit")
         return -1
 
@@ -79,6 +156,12 @@ def main():
     request_payload = os.getenv(REQ_PAYLOAD)
     if request_payload:
         request_payload = prepare_payload(os.getenv(REQ_PAYLOAD))
+    if os.getenv(REQ_PAYLOAD_TEMPLATE):
+        if request_payload:
+            logger.warning(f"{REQ_PAYLOAD_TEMPLATE} takes precedence over {REQ_PAYLOAD}")
+        request_payload = PayloadTemplate(prepare_payload(os.getenv(REQ_PAYLOAD_TEMPLATE)))
+        if request_method != "POST":
+            logger.warning(f"{REQ_PAYLOAD_TEMPLATE} is only sent with REQ_METHOD=POST")
     script = os.getenv(SCRIPT)
 
     _initialize_kubeclient_configuration()
@@ -99,8 +182,18 @@ def main():
         logger.info(f"5xx response content will not be enabled.")
         enable_5xx = False
 
+    pipelines = None
+    if pipelines_config:
+        pipelines = load_pipelines(pipelines_config, os.getenv(RESOURCE, "configmap"), folder_annotation,
+                                   unique_filenames, enable_5xx)
+        resources = pipeline_resources(pipelines)
+
     ignore_already_processed = False
-    if os.getenv(IGNORE_ALREADY_PROCESSED) is not None and os.getenv(IGNORE_ALREADY_PROCESSED).lower() == "true":
+    if os.getenv(IGNORE_ALREADY_PROCESSED, "false").lower() == "true" and uses_daemon():
+        # The daemon passes on the resource versions of the API server
+        logger.info("Ignore already processed resource version will be enabled.")
+        ignore_already_processed = True
+    elif os.getenv(IGNORE_ALREADY_PROCESSED) is not None and os.getenv(IGNORE_ALREADY_PROCESSED).lower() == "true":
         # Check API version
         try:
             version = client.VersionApi(api_client=get_api_client()).get_code()
@@ -121,16 +214,52 @@ def main():
     if not ignore_already_processed:
         logger.debug("Ignore already processed resource version will not be enabled.")
 
+    if WATCH_LIST and not uses_daemon():
+        # Older apiservers ignore sendInitialEvents and would never send the initial-events-end bookmark
+        try:
+            version = client.VersionApi(api_client=get_api_client()).get_code()
+            v_major = re.sub(r'\D', '', version.major)
+            v_minor = re.sub(r'\D', '', version.minor)
+            if not (len(v_major) and len(v_minor) and (int(v_major) > 1 or (int(v_major) == 1 and int(v_minor) >= 27))):
+                disable_watch_list(f"kubernetes api version {version.git_version} is lower than v1.27")
+        except ApiException as e:
+            disable_watch_list(f"unable to get the kubernetes api version: {e.reason}")
+
     with open("/var/run/secrets/kubernetes.io/serviceaccount/namespace") as f:
         namespace = os.getenv("NAMESPACE", f.read())
 
+    if daemon_mode:
+        from daemon import serve_daemon
+        serve_daemon(resources, namespace.split(','), label_selectors)
+
+    # Files recorded in a manifest from a previous run are checked for orphans after the initial sync
+    manifest_loaded = load_manifest()
+
+    if DRIFT_REPAIR:
+        if type(get_sink()) is FileSink:
+            start_drift_repair(repair_file)
+        else:
+            logger.warning("DRIFT_REPAIR is only supported with OUTPUT_SINK=files, drifted files won't be repaired.")
+
+    # Track the initial sync per namespace and resource, syncing the ones readiness waits for first
+    sync_order = [(res, ns) for res in resources for ns in namespace.split(',')]
+    for res, ns in sync_order:
+        register_sync_scope(f"{ns}/{res}")
+    for pipeline in pipelines or ():
+        register_sync_pipeline(pipeline.name, [f"{ns}/{res}" for res, ns in sync_order if res in pipeline.resources])
+    sync_order.sort(key=lambda scope: not is_ready_scope(f"{scope[1]}/{scope[0]}"))
+
     method = os.getenv(METHOD)
     if method == "LIST":
-        for res in resources:
-            for ns in namespace.split(','):
+        for res, ns in sync_order:
+            for label_selector in watched_label_selectors(res, label_selectors, pipelines):
                 list_resources(label, label_value, target_folder, request_url, request_method, request_payload,
                                ns, folder_annotation, res, unique_filenames, script, enable_5xx,
-                               ignore_already_processed, resource_name)
+                               ignore_already_processed, resource_name, label_selector, pipelines, True)
+            mark_synced(f"{ns}/{res}")
+        if manifest_loaded:
+            _remove_orphans(script, request_url, request_method, enable_5xx, request_payload, pipelines)
+        get_sink().reconcile()
         mark_ready()
     else:
         # For watch/sleep methods, do an initial list first to ensure files are there at startup
@@ -139,19 +268,23 @@ def main():
         if request_skip_init:
             init_request_url = None
             logger.info("Skipping initial request to external endpoint.")
-        for res in resources:
-            for ns in namespace.split(','):
+        for res, ns in sync_order:
+            for label_selector in watched_label_selectors(res, label_selectors, pipelines):
                 # For this initial list, we can set ignore_already_processed to True
                 # so the subsequent watch doesn't re-process immediately if that is enabled.
-                list_resources(label, label_value, target_folder, init_request_url, request_method, request_payload,
-                               ns, folder_annotation, res, unique_filenames, script, enable_5xx,
-                               True, resource_name)
+                list_resources(label, label_value, target_folder, init_request_url, request_method,
+                               request_payload, ns, folder_annotation, res, unique_filenames, script, enable_5xx,
+                               True, resource_name, label_selector, pipelines, True)
+            mark_synced(f"{ns}/{res}")
+        if manifest_loaded:
+            _remove_orphans(script, init_request_url, request_method, enable_5xx, request_payload, pipelines)
+        get_sink().reconcile()
 
         mark_ready()
         logger.info("Initial sync complete, sidecar is ready.")
         watch_for_changes(method, label, label_value, target_folder, request_url, request_method, request_payload,
                           namespace, folder_annotation, resources, unique_filenames, script, enable_5xx,
-                          ignore_already_processed, resource_name)
+                          ignore_already_processed, resource_name, label_selectors, pipelines)
     mark_ready() # After successful initial LIST sync
 
 if __name__ == "__main__":
@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+
+import errno
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+from collections import defaultdict
+from threading import Lock, local
+
+from helpers import CONTENT_TYPE_TEXT, remove_file, write_data_to_file
+from logger import get_logger
+
+SINK_FILES = "files"
+SINK_BUNDLE = "bundle"
+SINK_CONTENT_STORE = "content-store"
+SINK_ATOMIC = "atomic"
+
+LINK_HARDLINK = "hardlink"
+LINK_SYMLINK = "symlink"
+
+# Where the data keys of the watched resources end up
+OUTPUT_SINK = os.getenv("OUTPUT_SINK", SINK_FILES).lower()
+# Name of the bundle written into every target folder by the bundle sink
+BUNDLE_NAME = os.getenv("BUNDLE_NAME", "bundle.tar")
+# Directory of the content store, relative paths are resolved against every target folder. The default stays
+# inside the target folder: hardlinks need the same filesystem and relative symlinks must resolve in the
+# containers of the consumers, which usually mount just the target folder.
+CONTENT_STORE_DIR = os.getenv("CONTENT_STORE_DIR", ".blobs")
+# How target files reference the content store
+CONTENT_STORE_LINK = os.getenv("CONTENT_STORE_LINK", LINK_HARDLINK).lower()
+
+# Name of the symlink pointing to the current snapshot of a target folder written by the atomic sink
+DATA_DIR_NAME = "..data"
+
+# Get logger
+logger = get_logger()
+
+
+def _file_mode():
+    return int(os.getenv('DEFAULT_FILE_MODE'), base=8) if os.getenv('DEFAULT_FILE_MODE') else 0o644
+
+
+class FileSink:
+    """
+    Writes every data key into its own file in the target folder.
+    """
+
+    def write(self, folder, filename, data, data_type=CONTENT_TYPE_TEXT):
+        return write_data_to_file(folder, filename, data, data_type)
+
+    def remove(self, folder, filename):
+        return remove_file(folder, filename)
+
+    def flush(self):
+        """
+        Called at the end of every batch of changes, before scripts and requests are triggered.
+        """
+        pass
+
+    def reconcile(self):
+        """
+        Called once after the initial sync of all resources, to clean up state left by previous runs.
+        """
+        pass
+
+
+class BundleSink:
+    """
+    Materializes the content of every target folder as a single uncompressed tar bundle per folder.
+    Only the digests of the bundled files and the changes of the current batch are kept in memory.
+    Bundles are only rewritten for folders which changed during a batch, copying the unchanged members
+    from the previous bundle, and are swapped in atomically, so consumers never read a partial bundle.
+    """
+
+    def __init__(self, bundle_name):
+        self.bundle_name = bundle_name
+        self._folders = {}  # folder -> {filename: SHA-256 digest}, including the pending changes
+        self._pending = {}  # folder -> {filename: bytes, None if removed} not written to the bundle yet
+        self._lock = Lock()
+        self._flush_lock = Lock()  # bundles are rewritten from the previous one, one flush at a time
+
+    def _files_of(self, folder):
+        files = self._folders.get(folder)
+        if files is None:
+            # Files of a previous run stay until they are removed, e.g. as orphans of the manifest
+            files = self._folders[folder] = {member.name: hashlib.sha256(fileobj.read()).hexdigest()
+                                             for member, fileobj in self._members(folder)}
+        return files
+
+    def _members(self, folder):
+        """
+        Yield every file of the current bundle of a folder as (TarInfo, file object), in bundle order.
+        """
+        # tarfile is only needed with OUTPUT_SINK=bundle
+        import tarfile
+        try:
+            with tarfile.open(os.path.join(folder, self.bundle_name), mode="r:") as tar:
+                for member in tar:
+                    if member.isfile():
+                        yield member, tar.extractfile(member)
+        except FileNotFoundError:
+            return
+        except tarfile.TarError as e:
+            logger.warning(f"Ignoring unreadable bundle in {folder}: {e}")
+
+    def write(self, folder, filename, data, data_type=CONTENT_TYPE_TEXT):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if self._files_of(folder).get(filename) == digest:
+                logger.debug("Contents of %s haven't changed. Not updating bundle", filename)
+                return False
+            self._files_of(folder)[filename] = digest
+            self._pending.setdefault(folder, {})[filename] = data
+        logger.info("Adding %s to bundle in %s", filename, folder)
+        return True
+
+    def remove(self, folder, filename):
+        with self._lock:
+            if self._files_of(folder).pop(filename, None) is None:
+                logger.error("Unable to remove %s from bundle in %s, file not found", filename, folder)
+                return False
+            self._pending.setdefault(folder, {})[filename] = None
+        logger.info("Removing %s from bundle in %s", filename, folder)
+        return True
+
+    def reconcile(self):
+        pass
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for folder, changes in pending.items():
+                try:
+                    self._write_bundle(folder, changes)
+                except OSError as e:
+                    logger.error(f"Unable to write bundle to {folder}: {e}")
+                    with self._lock:
+                        # Changes made since are newer
+                        self._pending[folder] = {**changes, **self._pending.get(folder, {})}
+
+    def _write_bundle(self, folder, changes):
+        import tarfile
+        os.makedirs(folder, exist_ok=True)
+        mode = _file_mode()
+        mtime = time.time()
+        written = sorted(filename for filename, data in changes.items() if data is not None)
+        count = 0
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=f".{self.bundle_name}-")
+        try:
+            with os.fdopen(fd, "wb") as f, tarfile.open(fileobj=f, mode="w", format=tarfile.PAX_FORMAT) as tar:
+                def add(filename):
+                    info = tarfile.TarInfo(filename)
+                    info.size = len(changes[filename])
+                    info.mode = mode
+                    info.mtime = mtime
+                    tar.addfile(info, io.BytesIO(changes[filename]))
+
+                # Both the previous bundle and the written files are sorted, merge them
+                i = 0
+                for member, fileobj in self._members(folder):
+                    for filename in written[i:]:
+                        if filename >= member.name:
+                            break
+                        add(filename)
+                        i += 1
+                    if member.name not in changes:
+                        tar.addfile(member, fileobj)
+                        count += 1
+                for filename in written[i:]:
+                    add(filename)
+                count += len(written)
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, os.path.join(folder, self.bundle_name))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        logger.info("Wrote bundle %s with %d files", os.path.join(folder, self.bundle_name), count)
+
+
+class ContentStoreSink(FileSink):
+    """
+    Writes every distinct content once into a content-addressed store, named by its SHA-256 digest,
+    and materializes the target files as hardlinks or relative symlinks to it. Blobs are reference
+    counted and removed together with their last target file.
+    """
+
+    def __init__(self, store_dir, link_type):
+        self.store_dir = store_dir
+        self.link_type = link_type
+        self._blobs = {}  # target path -> blob path
+        self._refs = defaultdict(set)  # blob path -> target paths
+        self._stores = set()
+        self._lock = Lock()
+
+    def _store_for(self, folder):
+        return os.path.join(folder, self.store_dir)  # absolute store_dir wins
+
+    def _links_to(self, target, blob):
+        try:
+            if self.link_type == LINK_SYMLINK:
+                return os.path.islink(target) and os.path.realpath(target) == os.path.realpath(blob)
+            return os.path.samefile(target, blob)
+        except OSError:
+            return False
+
+    def write(self, folder, filename, data, data_type=CONTENT_TYPE_TEXT):
+        raw = data.encode("utf-8") if isinstance(data, str) else data
+        digest = hashlib.sha256(raw).hexdigest()
+        target = os.path.join(folder, filename)
+        store = self._store_for(folder)
+        blob = os.path.join(store, digest)
+
+        # Blobs are written and targets hashed without the lock, writers of the same content race harmlessly
+        if not self._ensure_blob(store, blob, raw, filename):
+            return False
+        changed = not self._links_to(target, blob) and not self._has_content(target, digest)
+
+        with self._lock:
+            self._stores.add(store)
+            # The last target referencing the blob may have been removed in the meantime
+            if not self._ensure_blob(store, blob, raw, filename):
+                return False
+            if self._links_to(target, blob):
+                self._reference(target, blob)
+                logger.debug("Contents of %s haven't changed. Not overwriting existing file", filename)
+                return False
+
+            try:
+                self._link(blob, target)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                logger.warning(f"Unable to link {target} to the content store ({e}), writing a copy instead")
+                self._dereference(target)
+                copy = changed
+            else:
+                self._reference(target, blob)
+                copy = False
+
+        if copy:
+            self._write_copy(target, raw)
+        if changed:
+            logger.info("Writing %s (%s, %s)", target, data_type, digest[:12])
+        return changed
+
+    def remove(self, folder, filename):
+        target = os.path.join(folder, filename)
+        with self._lock:
+            removed = remove_file(folder, filename)
+            self._dereference(target)
+        return removed
+
+    def reconcile(self):
+        """
+        Remove blobs which are not referenced by any target file written during this run.
+        """
+        with self._lock:
+            referenced = set(self._refs)
+            for store in self._stores:
+                try:
+                    with os.scandir(store) as entries:
+                        unreferenced = [entry.path for entry in entries
+                                        if entry.is_file(follow_symlinks=False) and entry.path not in referenced
+                                        and not entry.name.startswith(".")]
+                except FileNotFoundError:
+                    continue
+                for blob in unreferenced:
+                    logger.info(f"Removing unreferenced blob {blob}")
+                    os.remove(blob)
+
+    @classmethod
+    def _ensure_blob(cls, store, blob, raw, filename):
+        if os.path.exists(blob):
+            return True
+        try:
+            cls._write_blob(store, blob, raw)
+        except OSError as e:
+            if e.errno != errno.EACCES:
+                raise
+            logger.error(f"Error: insufficient privileges to write to {store}. Skipping {filename}.")
+            return False
+        return True
+
+    @staticmethod
+    def _write_blob(store, blob, raw):
+        os.makedirs(store, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=store, prefix=".blob-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(raw)
+        os.chmod(tmp_path, _file_mode())
+        os.replace(tmp_path, blob)
+
+    @staticmethod
+    def _write_copy(target, raw):
+        """
+        Atomically replace target with a copy of raw. Writing in place would change the shared blob
+        if target is still linked to it.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix=f".{os.path.basename(target)}.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(raw)
+            os.chmod(tmp_path, _file_mode())
+            os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _link(self, blob, target):
+        """
+        Atomically replace target with a link to blob.
+        """
+        folder = os.path.dirname(target)
+        os.makedirs(folder, exist_ok=True)
+        tmp_path = os.path.join(folder, f".{os.path.basename(target)}.{os.getpid()}.tmp")
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        if self.link_type == LINK_SYMLINK:
+            os.symlink(os.path.relpath(blob, folder), tmp_path)
+        else:
+            os.link(blob, tmp_path)
+        os.replace(tmp_path, target)
+
+    @staticmethod
+    def _has_content(target, digest):
+        sha256_hash = hashlib.sha256()
+        try:
+            with open(target, "rb") as f:
+                for byte_block in iter(lambda: f.read(4096), b""):
+                    sha256_hash.update(byte_block)
+        except (FileNotFoundError, IsADirectoryError):
+            return False
+        return sha256_hash.hexdigest() == digest
+
+    def _reference(self, target, blob):
+        previous = self._blobs.get(target)
+        if previous == blob:
+            return
+        self._dereference(target)
+        self._blobs[target] = blob
+        self._refs[blob].add(target)
+
+    def _dereference(self, target):
+        blob = self._blobs.pop(target, None)
+        if blob is None:
+            return
+        self._refs[blob].discard(target)
+        if not self._refs[blob]:
+            del self._refs[blob]
+            if os.path.exists(blob):
+                logger.debug("Removing unreferenced blob %s", blob)
+                os.remove(blob)
+
+
+class AtomicDirSink:
+    """
+    Materializes every batch of changes of a target folder as a new timestamped snapshot directory
+    and publishes it by atomically swapping the ..data symlink, like the kubelet does for volumes.
+    The visible files are symlinks through ..data, so consumers always see a complete snapshot.
+    Files which didn't change since the previous snapshot are hardlinked instead of rewritten.
+    """
+
+    def __init__(self):
+        self._folders = {}  # folder -> {filename: bytes} of the last flushed batch
+        self._published = {}  # folder -> {filename: bytes} of the current snapshot
+        self._dirty = set()  # folders of flushed batches whose snapshot failed to publish
+        self._staged = local()  # per thread: folder -> {filename: bytes, None if removed}
+        self._lock = Lock()
+
+    def _files_of(self, folder):
+        files = self._folders.get(folder)
+        if files is None:
+            # Files of a previous run stay until they are removed, e.g. as orphans of the manifest
+            self._published[folder] = self._read_snapshot(folder)
+            files = self._folders[folder] = dict(self._published[folder])
+        return files
+
+    def _batch(self, folder):
+        """
+        Return the changes the current thread staged for folder. Every watcher thread stages its own
+        batch, so a flush never publishes the half-applied object of another watcher.
+        """
+        batches = getattr(self._staged, "folders", None)
+        if batches is None:
+            batches = self._staged.folders = {}
+        return batches.setdefault(folder, {})
+
+    def _current(self, folder, filename):
+        batch = self._batch(folder)
+        if filename in batch:
+            return batch[filename]
+        with self._lock:
+            return self._files_of(folder).get(filename)
+
+    def write(self, folder, filename, data, data_type=CONTENT_TYPE_TEXT):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        previous = self._current(folder, filename)
+        self._batch(folder)[filename] = data
+        if previous == data:
+            logger.debug("Contents of %s haven't changed. Not overwriting existing file", filename)
+            return False
+        logger.info("Writing %s to the next snapshot of %s", filename, folder)
+        return True
+
+    def remove(self, folder, filename):
+        with self._lock:
+            exists = filename in self._files_of(folder)
+        batch = self._batch(folder)
+        if (batch[filename] is None) if filename in batch else not exists:
+            logger.error("Unable to remove %s from the snapshot of %s, file not found", filename, folder)
+            return False
+        batch[filename] = None
+        logger.info("Removing %s from the next snapshot of %s", filename, folder)
+        return True
+
+    def reconcile(self):
+        pass
+
+    def flush(self):
+        """
+        Apply the batch of the current thread and publish the folders it changed. The lock is held from
+        applying to swapping, so snapshots are published in the order of the batches.
+        """
+        batches = getattr(self._staged, "folders", None) or {}
+        self._staged.folders = {}
+        with self._lock:
+            for folder, batch in batches.items():
+                files = self._files_of(folder)
+                for filename, data in batch.items():
+                    if data is None:
+                        files.pop(filename, None)
+                    else:
+                        files[filename] = data
+                self._dirty.add(folder)
+            dirty, self._dirty = self._dirty, set()
+            for folder in sorted(dirty):
+                files = dict(self._folders[folder])
+                if files == self._published[folder]:
+                    continue
+                try:
+                    self._publish(folder, files)
+                except OSError as e:
+                    logger.error(f"Unable to publish snapshot of {folder}: {e}")
+                    self._dirty.add(folder)
+
+    @staticmethod
+    def _read_snapshot(folder):
+        """
+        Read the snapshot published by a previous run, so unchanged files are not reported as changes.
+        """
+        data_dir = os.path.join(folder, DATA_DIR_NAME)
+        files = {}
+        try:
+            with os.scandir(data_dir) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False):
+                        with open(entry.path, "rb") as f:
+                            files[entry.name] = f.read()
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return files
+
+    def _publish(self, folder, files):
+        os.makedirs(folder, exist_ok=True)
+        published = self._published[folder]
+        data_link = os.path.join(folder, DATA_DIR_NAME)
+        old_dir = os.path.join(folder, os.readlink(data_link)) if os.path.islink(data_link) else None
+        mode = _file_mode()
+
+        new_dir = tempfile.mkdtemp(dir=folder, prefix=time.strftime("..%Y_%m_%d_%H_%M_%S."))
+        try:
+            for filename, data in files.items():
+                path = os.path.join(new_dir, filename)
+                if old_dir is not None and published.get(filename) == data:
+                    try:
+                        os.link(os.path.join(old_dir, filename), path)
+                        continue
+                    except OSError:
+                        pass
+                with open(path, "wb") as f:
+                    f.write(data)
+                os.chmod(path, mode)
+            os.chmod(new_dir, 0o755)
+            self._replace_symlink(os.path.basename(new_dir), data_link)
+        except BaseException:
+            shutil.rmtree(new_dir, ignore_errors=True)
+            raise
+
+        for filename in files:
+            link = os.path.join(folder, filename)
+            target = os.path.join(DATA_DIR_NAME, filename)
+            if not os.path.islink(link) or os.readlink(link) != target:
+                self._replace_symlink(target, link)
+        for filename in published.keys() - files.keys():
+            link = os.path.join(folder, filename)
+            if os.path.islink(link) and os.readlink(link) == os.path.join(DATA_DIR_NAME, filename):
+                os.remove(link)
+        if old_dir is not None and os.path.realpath(old_dir) != os.path.realpath(new_dir):
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+        self._published[folder] = files
+        logger.info("Published snapshot %s with %d files", new_dir, len(files))
+
+    @staticmethod
+    def _replace_symlink(target, link):
+        tmp_path = f"{link}.{os.getpid()}.tmp"
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        os.symlink(target, tmp_path)
+        os.replace(tmp_path, link)
+
+
+def _create_sink():
+    if OUTPUT_SINK == SINK_BUNDLE:
+        logger.info(f"Files will be bundled into {BUNDLE_NAME} in every target folder.")
+        return BundleSink(BUNDLE_NAME)
+    if OUTPUT_SINK == SINK_CONTENT_STORE:
+        if CONTENT_STORE_LINK not in (LINK_HARDLINK, LINK_SYMLINK):
+            logger.warning(f"Unknown CONTENT_STORE_LINK '{CONTENT_STORE_LINK}', using {LINK_HARDLINK}s instead.")
+            return ContentStoreSink(CONTENT_STORE_DIR, LINK_HARDLINK)
+        logger.info(f"Identical files will be deduplicated with {CONTENT_STORE_LINK}s into {CONTENT_STORE_DIR}.")
+        return ContentStoreSink(CONTENT_STORE_DIR, CONTENT_STORE_LINK)
+    if OUTPUT_SINK == SINK_ATOMIC:
+        logger.info(f"Every batch of changes will be published atomically through {DATA_DIR_NAME} in every target folder.")
+        return AtomicDirSink()
+    if OUTPUT_SINK != SINK_FILES:
+        logger.warning(f"Unknown OUTPUT_SINK '{OUTPUT_SINK}', writing files instead.")
+    return FileSink()
+
+
+_sink = _create_sink()
+
+
+def get_sink():
+    return _sink
+
+
+def supports_worker_processes():
+    """
+    Worker processes each hold their own copy of the sink state, which only works if the
+    sink keeps no state across writes.
+    """
+    return type(_sink) is FileSink
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Local harness for the node-level daemon (METHOD=DAEMON), runs without a cluster.
+
+Serves a cache filled with fake objects on a temporary Unix socket, the way the daemon does, and
+runs the list and watch code of a sidecar in client mode (DAEMON_SOCKET) against it: the initial
+sync, label selectors, objects entering and leaving the selection, expired resource versions and
+timeouts of a daemon that has not synced or does not answer.
+
+Usage: python test/daemon_socket.py
+"""
+
+import os
+import socket
+import sys
+import tempfile
+import time
+from threading import Thread
+
+WORK_DIR = tempfile.mkdtemp(prefix="k8s-sidecar-daemon-")
+os.environ.update(DAEMON_SOCKET=os.path.join(WORK_DIR, "daemon.sock"), METHOD="WATCH", WATCH_SERVER_TIMEOUT="2",
+                  DAEMON_SYNC_TIMEOUT="1", DAEMON_CLIENT_TIMEOUT="3")
+sys.argv = sys.argv[:1]
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+# In the sidecar image the modules are installed, next to the pinned kubernetes client
+if os.path.isdir(SRC_DIR):
+    sys.path.insert(0, SRC_DIR)
+
+from kubernetes import watch  # noqa: E402
+from kubernetes.client.rest import ApiException  # noqa: E402
+
+import daemon  # noqa: E402
+import resources  # noqa: E402
+
+OUT_DIR = os.path.join(WORK_DIR, "out")
+SYNC_ARGS = dict(label="app", label_value="grafana", target_folder=OUT_DIR, request_url=None, request_method=None,
+                 request_payload=None, namespace="default", folder_annotation="k8s-sidecar-target-directory",
+                 resource="configmap", unique_filenames=False, script=None, enable_5xx=False)
+
+
+def config_map(name, app, data, resource_version):
+    return {"metadata": {"name": name, "namespace": "default", "resourceVersion": str(resource_version),
+                         "labels": {"app": app}},
+            "data": data}
+
+
+def files():
+    return sorted(os.listdir(OUT_DIR)) if os.path.isdir(OUT_DIR) else []
+
+
+def check(description, actual, expected):
+    if actual != expected:
+        print(f"FAIL: {description}: expected {expected}, got {actual}")
+        sys.exit(1)
+    print(f"ok: {description}")
+
+
+def main():
+    cache = daemon.ObjectCache(history=3)
+    cache.replace("configmap", "default", [config_map("a", "grafana", {"a.json": "A"}, 1),
+                                           config_map("b", "other", {"b.json": "B"}, 1)])
+    daemon.start_daemon_server(os.environ["DAEMON_SOCKET"], cache, ["configmap"], ["default", "unsynced"])
+
+    resources.list_resources(ignore_already_processed=True, resource_name="", **SYNC_ARGS)
+    check("initial sync writes the selected objects", files(), ["a.json"])
+
+    watcher = Thread(target=resources._watch_resource_iterator,
+                     kwargs=dict(ignore_already_processed=True, **SYNC_ARGS))
+    watcher.start()
+    time.sleep(0.5)
+    cache.apply("configmap", "MODIFIED", config_map("b", "grafana", {"b.json": "B"}, 2))
+    cache.apply("configmap", "MODIFIED", config_map("a", "other", {"a.json": "A"}, 2))
+    cache.apply("configmap", "ADDED", config_map("c", "grafana", {"c.json": "C"}, 3))
+    watcher.join()
+    check("watched objects entering and leaving the selection", files(), ["b.json", "c.json"])
+
+    cache.apply("configmap", "DELETED", config_map("c", "grafana", {"c.json": "C"}, 4))
+    resources.list_resources(ignore_already_processed=True, resource_name="", **SYNC_ARGS)
+    check("list removes deleted objects", files(), ["b.json"])
+
+    try:
+        list(watch.Watch().stream(daemon.DaemonApi().list_namespaced_config_map, namespace="default",
+                                  resource_version=cache.resource_version(0), timeout_seconds=1))
+        check("expired resource version is rejected", None, 410)
+    except ApiException as e:
+        check("expired resource version is rejected", e.status, 410)
+
+    try:
+        daemon.DaemonApi().list_namespaced_secret(namespace="default")
+        check("resources the daemon doesn't cache are rejected", None, 403)
+    except ApiException as e:
+        check("resources the daemon doesn't cache are rejected", e.status, 403)
+
+    try:
+        daemon.DaemonApi().list_namespaced_config_map(namespace="unsynced")
+        check("requests for objects the daemon hasn't listed yet time out", None, 503)
+    except ApiException as e:
+        check("requests for objects the daemon hasn't listed yet time out", e.status, 503)
+
+    # A daemon that accepts connections but never answers
+    silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    silent.bind(os.path.join(WORK_DIR, "silent.sock"))
+    silent.listen()
+    started = time.monotonic()
+    try:
+        daemon.DaemonApi(os.path.join(WORK_DIR, "silent.sock")).list_namespaced_config_map(namespace="default")
+        check("lists of an unresponsive daemon time out", None, TimeoutError)
+    except TimeoutError:
+        check("lists of an unresponsive daemon time out", time.monotonic() - started < 10, True)
+    silent.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Import-time benchmark for the sidecar.
+
+Imports the sidecar module in fresh interpreters with `-X importtime`, reports the slowest
+imports and fails if the best run exceeds the budget or if a module that is meant to be
+loaded lazily shows up in the startup import graph.
+
+Usage: python test/import_time.py
+Env:   IMPORT_TIME_BUDGET_MS (default 1000), IMPORT_TIME_RUNS (default 5)
+"""
+
+import os
+import subprocess
+import sys
+
+BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", 1000))
+RUNS = int(os.getenv("IMPORT_TIME_RUNS", 5))
+
+# Modules which must not be imported just by importing the sidecar with the default configuration
+LAZY_MODULES = (
+    "argparse",     # CLI flags are parsed in main()
+    "logfmter",     # only needed for LOG_FORMAT=LOGFMT
+    "daemon",       # only needed for METHOD=DAEMON
+    "content_api",  # only needed with CONTENT_API_PORT
+    "profiler",     # only needed for PROFILE=true
+    "ctypes",       # inotify binding of DRIFT_REPAIR
+    "tarfile",      # only needed for OUTPUT_SINK=bundle
+    # multiprocessing (WATCHER_PROCESSES) can't be checked, the kubernetes client imports it anyway
+)
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+
+
+def measure():
+    env = dict(os.environ)
+    env.pop("LOG_FORMAT", None)
+    env.pop("LOG_CONFIG", None)
+    if os.path.isdir(SRC_DIR):
+        env["PYTHONPATH"] = os.path.abspath(SRC_DIR)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import sidecar"],
+                            env=env, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue  # header line
+        imports.append((int(cumulative), name.rstrip()))
+    # Top level imports are indented by a single space
+    total_us = sum(us for us, name in imports if not name.startswith("  "))
+    return total_us, imports
+
+
+def main():
+    runs = [measure() for _ in range(RUNS)]
+    total_us, imports = min(runs, key=lambda run: run[0])
+
+    print(f"Best of {RUNS}: importing sidecar took {total_us / 1000:.1f} ms (budget {BUDGET_MS:.0f} ms)")
+    for us, name in sorted(imports, reverse=True)[:15]:
+        print(f"  {us / 1000:8.1f} ms  {name.strip()}")
+
+    failed = False
+    imported = {name.strip() for us, name in imports}
+    for module in LAZY_MODULES:
+        if module in imported:
+            print(f"FAIL: {module} is imported at startup but should be loaded lazily")
+            failed = True
+    if total_us / 1000 > BUDGET_MS:
+        print("FAIL: import time exceeds the budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
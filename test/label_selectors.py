@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Checks of the merging of alternative label selectors into the fewest watches.
+
+Usage: python test/label_selectors.py
+"""
+
+import os
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+# In the sidecar image the modules are installed
+if os.path.isdir(SRC_DIR):
+    sys.path.insert(0, SRC_DIR)
+
+from label_selectors import get_label_selectors, merge_label_selectors  # noqa: E402
+
+CASES = (
+    # (selectors, expected merged selectors)
+    (["app"], ["app"]),
+    (["app=a", "app=b"], ["app in (a,b)"]),
+    (["app=a", "app=a"], ["app=a"]),
+    (["app", "app=a"], ["app"]),
+    (["app in (a,b)", "app"], ["app"]),
+    (["app in (a)", "app in (a,b)"], ["app in (a,b)"]),
+    (["app in (a,c)", "app in (a,b)"], ["app in (a,b,c)"]),
+    (["app=a,team=x", "app in (a,b)"], ["app in (a,b)"]),
+    (["app=a,team=x", "team"], ["team"]),
+    (["app!=a", "app"], ["app", "app!=a"]),
+    (["app=a", "team=b"], ["app=a", "team=b"]),
+    (["app=a,team=x", "app=b"], ["app=a,team=x", "app=b"]),
+)
+
+
+def check(description, actual, expected):
+    if actual != expected:
+        print(f"FAIL: {description}: expected {expected}, got {actual}")
+        return False
+    print(f"ok: {description}")
+    return True
+
+
+def main():
+    passed = all([check(" | ".join(selectors), merge_label_selectors(selectors), expected)
+                  for selectors, expected in CASES])
+    passed &= check("LABEL with LABEL_SELECTOR alternatives",
+                    get_label_selectors("grafana_dashboard", None, "grafana_dashboard in (1,true);x=y"),
+                    ["grafana_dashboard", "x=y"])
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())